@@ -14,53 +14,378 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
-from qgis.core import Qgis, QgsMessageLog, QgsProject
+from qgis.core import Qgis, QgsMessageLog, QgsProject, QgsProviderRegistry
 from qgis.server import QgsServerFilter, QgsConfigCache, QgsServerSettings
-from qgis.PyQt.QtCore import QFileInfo
-import shutil
+from qgis.PyQt.QtNetwork import QNetworkDiskCache
+from collections import OrderedDict
+from .dependencies import dependencyRegistry
+from .spool import InvalidationSpool
+import hashlib
+import json
+import queue
+import threading
+import time
 import os
 
 
+class ProjectWatcher:
+    """ Watches a bounded set of project files through the dependency
+        registry and invokes a callback once a file changed.
+    """
+
+    def __init__(self, callback, max_files):
+        self.callback = callback
+        self.max_files = max_files
+        # Watched paths, in least recently used order
+        self.files = OrderedDict()
+
+    def watch(self, path):
+        """ Watches path. Files which the file system watcher cannot watch
+            are still compared on DependencyRegistry.update().
+        """
+        if path in self.files:
+            self.files.move_to_end(path)
+            return
+        dependencyRegistry().add(path, ("watched", path), self.fileChanged)
+
+        self.files[path] = True
+        while len(self.files) > self.max_files:
+            evicted, _ = self.files.popitem(last=False)
+            dependencyRegistry().remove(("watched", evicted))
+
+    def fileChanged(self, key):
+        path = key[1]
+        # The registry drops the dependency before invoking the callback
+        self.files.pop(path, None)
+        self.watch(path)
+        self.callback(path)
+
+
+def prewarmPaths(spec):
+    """ Returns the project files in a comma separated list of project
+        files and directories
+    """
+    paths = []
+    for entry in filter(bool, map(str.strip, spec.split(","))):
+        if not os.path.isdir(entry):
+            paths.append(entry)
+            continue
+        for dirpath, dirnames, filenames in os.walk(entry):
+            dirnames.sort()
+            paths += [
+                os.path.join(dirpath, filename)
+                for filename in sorted(filenames)
+                if filename.lower().endswith((".qgs", ".qgz"))
+            ]
+    return paths
+
+
+class WmsCachePurger:
+    """ Removes the network disk cache entries of single projects.
+
+        The cache directory is scanned incrementally in a background thread,
+        and the URL of each cache entry is kept in an index, so that
+        entries are only read once.
+    """
+
+    def __init__(self, cache_dir, batch_size, pause_ms):
+        self.cache_dir = cache_dir
+        self.batch_size = batch_size
+        self.pause = pause_ms / 1000.
+        # Cache entry path -> (mtime, size, url)
+        self.entries = {}
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def purge(self, project, prefixes, dry_run=False):
+        """ Schedules the removal of all cache entries of project, i.e. all
+            entries whose URL starts with one of prefixes
+        """
+        self.queue.put((project, tuple(prefixes), dry_run))
+
+    def run(self):
+        disk_cache = QNetworkDiskCache()
+        while True:
+            project, prefixes, dry_run = self.queue.get()
+            try:
+                self.purgeEntries(disk_cache, project, prefixes, dry_run)
+            except Exception as e:
+                QgsMessageLog.logMessage(
+                    "Purging WMS cache of {} failed: {}".format(project, e),
+                    "ClearCapabilities", Qgis.Critical)
+
+    def updateIndex(self, disk_cache):
+        """ Adds new and modified cache entries to the index and drops
+            removed ones
+        """
+        seen = set()
+        for dirpath, dirnames, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                seen.add(path)
+                entry = self.entries.get(path)
+                if entry is None or entry[0] != st.st_mtime:
+                    url = disk_cache.fileMetaData(path).url().toString()
+                    self.entries[path] = (st.st_mtime, st.st_size, url)
+
+        for path in set(self.entries) - seen:
+            del self.entries[path]
+
+    def purgeEntries(self, disk_cache, project, prefixes, dry_run):
+        start = time.time()
+        self.updateIndex(disk_cache)
+
+        paths = [
+            path for path, (mtime, size, url) in self.entries.items()
+            if url and url.startswith(prefixes)
+        ]
+        size = sum(self.entries[path][1] for path in paths)
+        if dry_run:
+            QgsMessageLog.logMessage(
+                "WMS cache purge of {} would free {} bytes in {} files".format(
+                    project, size, len(paths)),
+                "ClearCapabilities", Qgis.Warning)
+            return
+
+        for i, path in enumerate(paths):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.entries.pop(path, None)
+            # Yield to the request threads between batches
+            if (i + 1) % self.batch_size == 0:
+                time.sleep(self.pause)
+
+        QgsMessageLog.logMessage(
+            "WMS cache of {} purged: {} bytes in {} files [{:.1f}s]".format(
+                project, size, len(paths), time.time() - start),
+            "ClearCapabilities", Qgis.Warning)
+
+
+class PrefixStore:
+    """ Keeps the URL prefixes of the remote layers of projects on disk, so
+        that a CLEARCACHE request also purges the network cache entries of
+        projects which the process has not loaded, e.g. after a restart or
+        when another process loaded them.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        try:
+            os.makedirs(store_dir, exist_ok=True)
+        except OSError as e:
+            QgsMessageLog.logMessage(
+                "Creating {} failed: {}".format(store_dir, e),
+                "ClearCapabilities", Qgis.Warning)
+
+    def path(self, project):
+        name = hashlib.sha1(project.encode("utf-8")).hexdigest() + ".json"
+        return os.path.join(self.store_dir, name)
+
+    def load(self, project):
+        """ Returns the stored prefixes of project, None if unknown """
+        try:
+            with open(self.path(project)) as fh:
+                data = json.load(fh)
+            if data["project"] == project:
+                return set(data["prefixes"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return None
+
+    def save(self, project, prefixes):
+        path = self.path(project)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(tmp_path, "w") as fh:
+                json.dump(
+                    {"project": project, "prefixes": sorted(prefixes)}, fh)
+            # Rename is atomic, other processes never read partial files
+            os.replace(tmp_path, path)
+        except OSError as e:
+            QgsMessageLog.logMessage(
+                "Storing URL prefixes of {} failed: {}".format(project, e),
+                "ClearCapabilities", Qgis.Warning)
+
+
+def cachedProject(path):
+    """ Returns the project in the QGIS Server config cache, or None if it
+        is not loaded. Unlike QgsConfigCache.project(), this never loads it.
+    """
+    for project in QgsConfigCache.instance().projects():
+        if project.fileName() == path:
+            return project
+    return None
+
+
+def projectUrlPrefixes(project):
+    """ Returns the URL prefixes of all remote layers of project """
+    registry = QgsProviderRegistry.instance()
+    prefixes = set()
+    for layer in project.mapLayers().values():
+        parts = registry.decodeUri(layer.providerType(), layer.source())
+        url = parts.get("url") or parts.get("path") or ""
+        if url.startswith("/vsicurl/"):
+            url = url[9:]
+        if not url.startswith(("http://", "https://")):
+            continue
+        # Strip query and tile template, e.g. of XYZ layers
+        url = url.split("?")[0].split("{")[0]
+        prefixes.add(url)
+    return prefixes
+
+
 class ClearCapabilitiesFilter(QgsServerFilter):
     """ QGIS Server ClearCapabilitiesFilter plugin. """
 
     def __init__(self, server_iface):
         super(ClearCapabilitiesFilter, self).__init__(server_iface)
-        self.projects = {}
+        self.watcher = ProjectWatcher(
+            self.projectChanged,
+            int(os.getenv("CLEAR_CAPABILITIES_MAX_WATCHED_PROJECTS", "500"))
+        )
+        settings = QgsServerSettings()
+        settings.load()
+        self.purger = WmsCachePurger(
+            os.path.join(settings.cacheDirectory(), 'data8'),
+            max(1, int(os.getenv("CLEAR_CAPABILITIES_PURGE_BATCH_SIZE", "100"))),
+            int(os.getenv("CLEAR_CAPABILITIES_PURGE_PAUSE_MS", "10"))
+        )
+        # URL prefixes of the remote layers of served projects, kept when
+        # the project is invalidated
+        self.projectUrls = {}
+        # Projects whose prefixes are indexed again once they are loaded
+        self.reindex = set()
+        self.prefixStore = PrefixStore(os.getenv(
+            "CLEAR_CAPABILITIES_PREFIX_DIR",
+            os.path.join(settings.cacheDirectory(), "clear_capabilities")))
+        self.spool = None
+        spool_dir = os.getenv("CLEAR_CAPABILITIES_SPOOL_DIR", "")
+        if spool_dir:
+            self.spool = InvalidationSpool(spool_dir)
+            self.spoolInterval = int(os.getenv(
+                "CLEAR_CAPABILITIES_SPOOL_INTERVAL_MS", "1000")) / 1000.
+            self.spoolPolled = time.monotonic()
+        for path in prewarmPaths(
+                os.getenv("CLEAR_CAPABILITIES_PREWARM_PROJECTS", "")):
+            self.prewarmProject(path)
 
     def requestReady(self):
         handler = self.serverInterface().requestHandler()
         params = handler.parameterMap()
+        project = params.get("MAP", "") or self.serverInterface().configFilePath()
+        if project:
+            self.watcher.watch(project)
+        # Apply changes before the request uses a project, the FCGI server
+        # does not process events between requests. The requested project
+        # is compared in any case, its change may not be notified yet.
+        dependencyRegistry().update([project] if project else [])
+        if (self.spool
+                and time.monotonic() - self.spoolPolled >= self.spoolInterval):
+            self.pollSpool()
         if params.get("CLEARCACHE") and params.get("MAP", ""):
-            self.clearWmsCache()
-            self.clearCache(params.get("MAP", ""))
-        elif (params.get("SERVICE", "").upper() in ["WMS", "WMTS", "WFS"]
-                and params.get("REQUEST", "").upper() in [
-                    "GETPROJECTSETTINGS", "GETCAPABILITIES"]
-                and params.get("MAP", "")):
-            self.clearCacheIfModified(params.get("MAP", ""))
-
-    def clearCacheIfModified(self, project):
-        """ Checks the project timestamps and clears cache on update """
-        fi = QFileInfo(project)
-
-        if fi.exists():
-            lm = fi.lastModified()
-
-            if self.projects.get(project, lm) < lm:
-                self.clearCache(project)
-                QgsMessageLog.logMessage(
-                    "Cached cleared after update: {} [{}]".format(
-                        project, lm.toString()),
-                    "ClearCapabilities", Qgis.Warning)
+            dry_run = params.get("DRYRUN", "").lower() in ["1", "true"]
+            self.clearWmsCache(params.get("MAP", ""), dry_run)
+            # A dry run only reports what would be purged
+            if not dry_run:
+                self.clearCache(params.get("MAP", ""))
+                if self.spool:
+                    self.spool.publish(params.get("MAP", ""))
 
-            self.projects[project] = lm
+    def responseComplete(self):
+        params = self.serverInterface().requestHandler().parameterMap()
+        project = params.get("MAP", "") or self.serverInterface().configFilePath()
+        if project and (
+                project not in self.projectUrls or project in self.reindex):
+            # Only index projects the request loaded, never load them here
+            qgs_project = cachedProject(project)
+            if qgs_project:
+                self.indexProject(project, qgs_project)
 
-    def clearWmsCache(self):
-        settings = QgsServerSettings()
-        settings.load()
-        shutil.rmtree(os.path.join(settings.cacheDirectory(), 'data8'),
-                      ignore_errors=True)
+    def indexProject(self, project, qgs_project):
+        """ Records the URL prefixes of the remote layers of the loaded
+            project, an empty set if it has none
+        """
+        prefixes = projectUrlPrefixes(qgs_project)
+        self.reindex.discard(project)
+        previous = self.projectUrls.get(project)
+        if previous is None:
+            previous = self.prefixStore.load(project)
+        if prefixes != previous:
+            self.prefixStore.save(project, prefixes)
+        self.projectUrls[project] = prefixes
+        # Auxiliary storage of .qgs projects
+        if project.lower().endswith(".qgs"):
+            dependencyRegistry().add(
+                os.path.splitext(project)[0] + ".qgd",
+                ("project", project), self.dependencyChanged)
+
+    def pollSpool(self):
+        """ Applies the invalidations published by other workers """
+        self.spoolPolled = time.monotonic()
+        for project in self.spool.poll():
+            self.clearCache(project)
+            QgsMessageLog.logMessage(
+                "Cached cleared by other worker: {}".format(project),
+                "ClearCapabilities", Qgis.Warning)
+
+    def prewarmProject(self, project):
+        """ Loads project into the config cache at server start, before the
+            process accepts requests
+        """
+        start = time.time()
+        try:
+            qgs_project = QgsConfigCache.instance().project(project)
+        except Exception as e:
+            qgs_project = None
+            QgsMessageLog.logMessage(
+                "Warm-up of {} failed: {}".format(project, e),
+                "ClearCapabilities", Qgis.Critical)
+        if qgs_project:
+            QgsMessageLog.logMessage(
+                "Warmed up {} [{:.1f}s]".format(project, time.time() - start),
+                "ClearCapabilities", Qgis.Info)
+            self.watcher.watch(project)
+            self.indexProject(project, qgs_project)
+
+    def dependencyChanged(self, key):
+        """ Clears the cache of a project after one of its auxiliary files
+            changed
+        """
+        self.projectChanged(key[1])
+
+    def projectChanged(self, project):
+        """ Clears the cache of a watched project after it changed """
+        self.clearCache(project)
+        QgsMessageLog.logMessage(
+            "Cached cleared after update: {}".format(project),
+            "ClearCapabilities", Qgis.Warning)
+
+    def clearWmsCache(self, project, dry_run=False):
+        """ Purges the WMS cache entries of the remote layers of project """
+        prefixes = self.projectUrls.get(project)
+        if prefixes is None:
+            qgs_project = cachedProject(project)
+            if qgs_project:
+                self.indexProject(project, qgs_project)
+                prefixes = self.projectUrls[project]
+            else:
+                # Recorded by an earlier or another process
+                prefixes = self.prefixStore.load(project)
+        if prefixes is None:
+            QgsMessageLog.logMessage(
+                "WMS cache of {} not purged: remote layers unknown".format(
+                    project),
+                "ClearCapabilities", Qgis.Warning)
+            return
+        if prefixes:
+            self.purger.purge(project, prefixes, dry_run)
         # QgsProject.instance().removeAllMapLayers()
 
     def clearCache(self, project):
@@ -68,6 +393,10 @@ class ClearCapabilitiesFilter(QgsServerFilter):
         # cache = QgsCapabilitiesCache()
         # cache.removeCapabilitiesDocument(project)
         self.serverInterface().removeConfigCacheEntry(project)
+        # Layers may have changed, index again once the project is loaded.
+        # The last known prefixes are kept for CLEARCACHE until then.
+        if project in self.projectUrls:
+            self.reindex.add(project)
 
         QgsMessageLog.logMessage(
             "Cached cleared : {}".format(project),
@@ -82,4 +411,6 @@ class ClearCapabilities:
     def __init__(self, server_iface):
         """Register the filter"""
         clear_capabilities = ClearCapabilitiesFilter(server_iface)
-        server_iface.registerFilter(clear_capabilities)
+        # Filters with lower priority are called first, invalidate before
+        # the filters of other plugins use a project
+        server_iface.registerFilter(clear_capabilities, -100)
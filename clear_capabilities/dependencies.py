@@ -0,0 +1,183 @@
+#
+# Copyright (c) 2024 Marco Hugentobler, Sourcepole AG
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Registry of the files from which cached artifacts are derived.
+
+Plugins register each file they read together with the key of the cached
+artifact and a callback, which is invoked with the key once the file was
+modified, created or removed. Registered directories are reported when
+entries are created, removed or renamed in them:
+
+    try:
+        from clear_capabilities.dependencies import dependencyRegistry
+    except ImportError:
+        dependencyRegistry = None
+
+    if dependencyRegistry:
+        dependencyRegistry().add(path, key, self.invalidate)
+
+The callbacks are only invoked from update(), which the clear_capabilities
+filter calls at the start of each request, before any project is used.
+"""
+
+from qgis.core import Qgis, QgsMessageLog
+from qgis.PyQt.QtCore import QFileSystemWatcher, QObject
+import os
+import time
+
+
+class DependencyRegistry(QObject):
+    """ Watches the dependencies of cached artifacts and invalidates the
+        artifacts derived from a file once a burst of changes has settled.
+
+        The FCGI server only processes events during requests, partly in
+        nested event loops while a project is rendered, so the watcher
+        signals only record the changed paths. update() applies them, and
+        compares the modification times of all dependencies in an interval
+        to also notice changes whose signal was not delivered yet.
+    """
+
+    def __init__(self, debounce_ms, check_interval_ms):
+        super(DependencyRegistry, self).__init__()
+        self.debounce = debounce_ms / 1000.
+        self.checkInterval = check_interval_ms / 1000.
+        self.checked = time.monotonic()
+        # path -> {key: callback}
+        self.dependencies = {}
+        # key -> set of paths
+        self.keys = {}
+        # path -> last seen mtime, None if the file does not exist
+        self.mtimes = {}
+        # path -> monotonic time of the last change signal
+        self.changed = {}
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.fileChanged.connect(self.pathChanged)
+        self.watcher.directoryChanged.connect(self.directoryChanged)
+
+    def add(self, path, key, callback):
+        """ Registers path as dependency of the artifact key, returns whether
+            changes of path are watched
+        """
+        path = os.path.abspath(path)
+        self.dependencies.setdefault(path, {})[key] = callback
+        self.keys.setdefault(key, set()).add(path)
+        if path not in self.mtimes:
+            self.mtimes[path] = mtime(path)
+            if self.mtimes[path] is not None:
+                self.watcher.addPath(path)
+            # Watch the directory to notice files which are created or replaced
+            directory = os.path.dirname(path)
+            if directory not in self.watcher.directories():
+                self.watcher.addPath(directory)
+        return self.isWatched(path)
+
+    def isWatched(self, path):
+        return path in self.watcher.files() or path in self.watcher.directories()
+
+    def remove(self, key):
+        """ Drops all dependencies of the artifact key """
+        for path in self.keys.pop(key, set()):
+            dependants = self.dependencies.get(path, {})
+            dependants.pop(key, None)
+            if not dependants:
+                self.dropPath(path)
+
+    def dropPath(self, path):
+        self.dependencies.pop(path, None)
+        self.mtimes.pop(path, None)
+        self.changed.pop(path, None)
+        for watched in [path, os.path.dirname(path)]:
+            # Directories stay watched as long as they contain dependencies
+            if (watched not in self.mtimes and self.isWatched(watched)
+                    and not any(os.path.dirname(p) == watched for p in self.mtimes)):
+                self.watcher.removePath(watched)
+
+    def directoryChanged(self, directory):
+        now = time.monotonic()
+        for path in self.mtimes:
+            if path == directory or os.path.dirname(path) == directory:
+                self.changed[path] = now
+
+    def pathChanged(self, path):
+        # Every change of a burst restarts the debounce delay
+        if path in self.mtimes:
+            self.changed[path] = time.monotonic()
+
+    def update(self, paths=()):
+        """ Invokes the callbacks of the dependencies which changed since the
+            last update. The modification time of paths is compared in any
+            case, e.g. of the project a request is about to use.
+        """
+        now = time.monotonic()
+        candidates = set(
+            path for path in paths if os.path.abspath(path) in self.mtimes)
+        for path, changed in list(self.changed.items()):
+            if now - changed >= self.debounce:
+                del self.changed[path]
+                candidates.add(path)
+        if now - self.checked >= self.checkInterval:
+            self.checked = now
+            candidates.update(self.mtimes)
+
+        for path in map(os.path.abspath, candidates):
+            if path not in self.mtimes:
+                # Dropped by the callback of another path
+                continue
+            current = mtime(path)
+            if current == self.mtimes[path]:
+                continue
+            if (current is not None
+                    and time.time_ns() - current < self.debounce * 1e9):
+                # Still being written, check again once the burst settled
+                self.changed.setdefault(path, now)
+                continue
+            self.invalidate(path, current)
+
+    def invalidate(self, path, current):
+        self.mtimes[path] = current
+        # Files replaced by a rename drop out of the watcher, add them again
+        if current is not None and not self.isWatched(path):
+            self.watcher.addPath(path)
+
+        for key, callback in list(self.dependencies.get(path, {}).items()):
+            self.remove(key)
+            try:
+                callback(key)
+            except Exception as e:
+                QgsMessageLog.logMessage(
+                    "Invalidating {} failed: {}".format(key, e),
+                    "ClearCapabilities", Qgis.Critical)
+
+
+def mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+_registry = None
+
+
+def dependencyRegistry():
+    """ Returns the registry shared by all plugins """
+    global _registry
+    if _registry is None:
+        _registry = DependencyRegistry(
+            int(os.getenv("CLEAR_CAPABILITIES_DEBOUNCE_MS", "500")),
+            int(os.getenv("CLEAR_CAPABILITIES_CHECK_INTERVAL_MS", "5000")))
+    return _registry
@@ -0,0 +1,108 @@
+#
+# Copyright (c) 2024 Marco Hugentobler, Sourcepole AG
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Invalidation spool shared by the QGIS Server processes of a node.
+
+Only depends on the standard library, so that it can be tested with
+several local processes without QGIS.
+"""
+
+import hashlib
+import os
+import uuid
+
+
+class InvalidationSpool:
+    """ Shares cache invalidations between the worker processes of a node
+        through a spool directory.
+
+        Each project has one file in the directory, which holds a unique
+        generation token, the publishing process and the project path. A
+        publication replaces the file, and workers apply the invalidations
+        whose generation differs from the last one they have seen. Files
+        are never removed, so a worker which did not poll for a long time
+        still notices the latest invalidation of every project.
+    """
+
+    def __init__(self, spool_dir):
+        self.spool_dir = spool_dir
+        self.pid = os.getpid()
+        self.started = False
+        os.makedirs(spool_dir, exist_ok=True)
+        # Invalidation file name -> (inode, mtime, generation)
+        self.seen = {}
+        # Invalidations published before the start do not concern this process
+        self.poll()
+        self.started = True
+
+    def entries(self):
+        """ Returns the invalidation files, (name, inode, mtime) tuples """
+        try:
+            return [
+                (entry.name, entry.inode(), entry.stat().st_mtime_ns)
+                for entry in os.scandir(self.spool_dir)
+                if entry.name.endswith(".inv")
+            ]
+        except OSError:
+            return []
+
+    def publish(self, project):
+        """ Publishes the invalidation of project to all other workers """
+        name = hashlib.sha1(project.encode("utf-8")).hexdigest() + ".inv"
+        generation = uuid.uuid4().hex
+        # Temporary files don't end in .inv and are never read by workers
+        tmp_path = os.path.join(
+            self.spool_dir, "{}.{}.tmp".format(name, generation))
+        with open(tmp_path, "w") as fh:
+            fh.write("{}\n{}\n{}".format(generation, self.pid, project))
+        # The rename keeps inode and mtime, stat before another worker can
+        # replace the file again
+        st = os.stat(tmp_path)
+        # Rename is atomic, readers never see partially written files
+        os.replace(tmp_path, os.path.join(self.spool_dir, name))
+        self.seen[name] = (st.st_ino, st.st_mtime_ns, generation)
+
+    def read(self, name):
+        """ Returns the (generation, pid, project) of an invalidation file,
+            or None if it is missing or malformed
+        """
+        try:
+            with open(os.path.join(self.spool_dir, name)) as fh:
+                generation, pid, project = fh.read().split("\n", 2)
+            return generation, int(pid), project
+        except (OSError, ValueError):
+            return None
+
+    def poll(self):
+        """ Returns the projects invalidated by other workers since the last
+            poll
+        """
+        projects = []
+        for name, inode, mtime in sorted(self.entries()):
+            seen = self.seen.get(name)
+            # Every publication replaces the file, skip unchanged ones
+            if seen and seen[:2] == (inode, mtime):
+                continue
+            entry = self.read(name)
+            if entry is None:
+                continue
+            generation, pid, project = entry
+            changed = seen[2] != generation if seen else self.started
+            if changed and pid != self.pid:
+                projects.append(project)
+            self.seen[name] = (inode, mtime, generation)
+        return projects
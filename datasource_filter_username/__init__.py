@@ -14,8 +14,7 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
-from .datasource_filter_username import DatasourceFilterUsername
-
 
 def serverClassFactory(serverIface):
+    from .datasource_filter_username import DatasourceFilterUsername
     return DatasourceFilterUsername(serverIface)
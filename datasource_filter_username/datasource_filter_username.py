@@ -16,56 +16,151 @@
 
 from qgis.core import *
 from qgis.server import *
+from qgis.PyQt.QtCore import QUrl
+from .subset_template import SubsetTemplate
+
+# Request parameters holding layer names
+LAYER_PARAMETERS = ["LAYERS", "QUERY_LAYERS", "LAYER", "TYPENAME", "TYPENAMES"]
+
+class TemplatedLayers:
+    """ Index of the layers of a project whose subset string contains $QWC_<NAME>$ placeholders """
+
+    def __init__(self, project):
+        # Layer id -> SubsetTemplate
+        self.templates = {}
+        # WMS layer or group name -> ids of the templated layers it contains
+        self.names = {}
+
+        useLayerIds = QgsServerProjectUtils.wmsUseLayerIds(project)
+        for layer in project.mapLayers().values():
+            subset = layer.subsetString() if layer.providerType() == "postgres" else ""
+            template = SubsetTemplate(subset) if subset and "$QWC_" in subset else None
+            if template and template.slots:
+                self.templates[layer.id()] = template
+            layerIds = [layer.id()] if layer.id() in self.templates else []
+            name = layer.id() if useLayerIds else (layer.shortName() or layer.name())
+            self.names.setdefault(name, set()).update(layerIds)
+
+        for group in project.layerTreeRoot().findGroups(True):
+            layerIds = [layerId for layerId in group.findLayerIds() if layerId in self.templates]
+            name = group.customProperty("wmsShortName") or group.name()
+            self.names.setdefault(name, set()).update(layerIds)
+
+        # Templated layers which other layers access without them being named in the request
+        self.indirect = set()
+        for layer in project.mapLayers().values():
+            self.indirect.update(self.referencedLayerIds(project, layer))
+        for relation in project.relationManager().relations().values():
+            self.indirect.update([relation.referencedLayerId(), relation.referencingLayerId()])
+        self.indirect.intersection_update(self.templates)
+
+        self.placeholders = set()
+        for template in self.templates.values():
+            self.placeholders.update(template.placeholders)
+
+    def referencedLayerIds(self, project, layer):
+        """ Returns the ids of the layers referenced by joins, value relations, virtual layer
+            sources and expression fields of layer """
+        if not isinstance(layer, QgsVectorLayer):
+            return set()
+        layerIds = set(join.joinLayerId() for join in layer.vectorJoins())
+        fields = layer.fields()
+        for idx in range(fields.count()):
+            setup = fields.at(idx).editorWidgetSetup()
+            if setup.type() == "ValueRelation":
+                layerIds.add(setup.config().get("Layer", ""))
+            if fields.fieldOrigin(idx) == QgsFields.OriginExpression:
+                # Layers referenced by get_feature(), aggregate() etc. by id or name
+                expression = layer.expressionField(idx)
+                layerIds.update(
+                    layerId for layerId in self.templates
+                    if layerId in expression or project.mapLayer(layerId).name() in expression
+                )
+        if layer.providerType() == "virtual":
+            definition = QgsVirtualLayerDefinition.fromUrl(QUrl(layer.source()))
+            layerIds.update(
+                source.reference() for source in definition.sourceLayers() if source.isReferenced()
+            )
+        return layerIds
+
+    def requestedLayerIds(self, names):
+        """ Returns the ids of the templated layers referenced by names and of the templated
+            layers accessed through other layers, or all templated layers if a name is unknown,
+            i.e. refers to the project root """
+        layerIds = set(self.indirect)
+        for name in names:
+            if name not in self.names:
+                return self.templates.keys()
+            layerIds.update(self.names[name])
+        return layerIds
 
 class DatasourceFilterUsernameFilter(QgsServerFilter):
     def __init__(self, serverIface):
         super(DatasourceFilterUsernameFilter, self).__init__(serverIface)
-        self._original_subsets = {}
-        
+        # Project path -> TemplatedLayers
+        self._indexes = {}
+
     def onRequestReady(self):
-        
-        request = self.serverInterface().requestHandler()
-        username = request.parameter('QWC_USERNAME')
-        QgsMessageLog.logMessage('Got QWC_USERNAME=%s' % (username), "[DatasourceFilterUsername]", Qgis.Info)
 
-        if not username:
-            return True
+        request = self.serverInterface().requestHandler()
 
         projectPath = self.serverInterface().configFilePath()
         try:
             project = QgsConfigCache.instance().project(projectPath)
-        except:
+        except Exception:
+            return True
+        if not project:
             return True
 
-        for layer in project.mapLayers().values():
-            if layer.providerType() != "postgres":
-                continue
-
-            subset = layer.subsetString()
-            if subset and "$QWC_USERNAME$" in subset:
-                self._original_subsets[layer.id()] = subset
-                layer.setSubsetString(subset.replace("$QWC_USERNAME$", username))
-                QgsMessageLog.logMessage('Replaced $QWC_USERNAME$ with %s in layer "%s" subset filter' % (username, layer.name()), "[DatasourceFilterUsername]", Qgis.Info)
-
-        return True
-
-    def onResponseComplete(self):
-
-        project_path = self.serverInterface().configFilePath()
-        try:
-            project = QgsConfigCache.instance().project(projectPath)
-        except:
+        index = self._indexes.get(projectPath)
+        if index is None:
+            index = TemplatedLayers(project)
+            self._indexes[projectPath] = index
+            # Build the index again once the project is removed from the config cache
+            project.destroyed.connect(lambda: self._indexes.pop(projectPath, None))
+        if not index.templates:
             return True
 
-        for layer_id, original_subset in self._original_subsets.items():
-            layer = project.mapLayer(layer_id)
-            if layer:
-                layer.setSubsetString(original_subset)
+        # The subset strings of the layers of the cached project are not restored after the
+        # request, but set for every request which references the layers. Requests are
+        # processed sequentially, so no request sees the filter of another user, and
+        # consecutive requests of the same user don't reload the provider.
+        names = self.requestedLayerNames(request)
+        if names is None:
+            layerIds = index.templates.keys()
+        else:
+            layerIds = index.requestedLayerIds(names)
 
-        self._original_subsets = {}
+        values = dict((name, request.parameter(name)) for name in index.placeholders)
+        changed = 0
+        for layerId in layerIds:
+            layer = project.mapLayer(layerId)
+            if not layer:
+                continue
+            subset = index.templates[layerId].render(values)
+            if layer.subsetString() != subset:
+                layer.setSubsetString(subset)
+                changed += 1
 
+        if changed:
+            QgsMessageLog.logMessage('Replaced %s in %d layer subset filters' % (values, changed), "[DatasourceFilterUsername]", Qgis.Info)
         return True
 
+    def requestedLayerNames(self, request):
+        """ Returns the layer names referenced by the request, or None if the request does not
+            list the layers it accesses """
+        params = request.parameterMap()
+        names = []
+        for key, value in params.items():
+            if key in LAYER_PARAMETERS:
+                names += filter(bool, value.split(","))
+
+        # Print layouts may access any layer, e.g. in maps without LAYERS,
+        # attribute tables or the atlas coverage layer
+        if not names or params.get("REQUEST", "").upper() == "GETPRINT":
+            return None
+        return names
+
 class DatasourceFilterUsername:
     def __init__(self, serverIface):
         self.iface = serverIface
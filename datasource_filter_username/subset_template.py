@@ -0,0 +1,159 @@
+#
+# Copyright (c) 2025 Sandro Mani, Sourcepole AG
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Datasource filter templates with $QWC_<NAME>$ placeholders.
+
+Only depends on the standard library, so that it can be tested without QGIS.
+"""
+
+import os
+import re
+
+# $QWC_<NAME>$ placeholders
+PLACEHOLDER_RE = re.compile(r"\$(QWC_[A-Z0-9_]+)\$")
+# $tag$ and $$ delimiters of dollar quoted strings
+DOLLAR_TAG_RE = re.compile(r"\$([A-Za-z_][A-Za-z0-9_]*)?\$")
+# Placeholders which are replaced, others are left unchanged
+PLACEHOLDERS = set(filter(bool, os.getenv("DATASOURCE_FILTER_PLACEHOLDERS", "QWC_USERNAME").split(",")))
+# Placeholders whose values are comma separated lists
+LIST_PLACEHOLDERS = set(filter(bool, os.getenv("DATASOURCE_FILTER_LIST_PLACEHOLDERS", "QWC_GROUPS,QWC_ROLES").split(",")))
+
+def sqlEscape(value, escapeString=False):
+    """ Escapes value for use within a SQL string literal, respectively an E'' escape string """
+    value = value.replace("\0", "")
+    if escapeString:
+        value = value.replace("\\", "\\\\")
+    return value.replace("'", "''")
+
+class SubsetTemplate:
+    """ Subset string with $QWC_<NAME>$ placeholders, compiled into literal parts and slots.
+
+    The subset string is tokenized as PostgreSQL SQL. Placeholders within a string literal
+    ('$QWC_USERNAME$' or E'$QWC_USERNAME$') are replaced by the escaped value. Other placeholders
+    are replaced by a SQL string literal, or for list placeholders by a comma separated list of
+    literals for use in IN (...) clauses, an empty list is replaced by NULL. Placeholders within
+    quoted identifiers, comments and dollar quoted strings ($$...$$ or $tag$...$tag$), and
+    placeholders not in PLACEHOLDERS are left unchanged.
+    """
+
+    def __init__(self, template):
+        # Alternating literal parts and placeholder names, starting and ending with a literal
+        self.parts = []
+        # (placeholder name, "escaped", "escaped_e", "list" or "literal")
+        self.slots = []
+        pos = 0
+        for start, end, name, context in self.tokenize(template):
+            if name not in PLACEHOLDERS or context not in ["code", "string", "escape_string"]:
+                continue
+            self.parts.append(template[pos:start])
+            if context in ["string", "escape_string"]:
+                self.slots.append((name, "escaped" if context == "string" else "escaped_e"))
+            elif name in LIST_PLACEHOLDERS:
+                self.slots.append((name, "list"))
+            else:
+                self.slots.append((name, "literal"))
+            pos = end
+        self.parts.append(template[pos:])
+        self.placeholders = set(name for name, mode in self.slots)
+
+    @staticmethod
+    def tokenize(template):
+        """ Yields (start, end, name, context) of the placeholders in template, where context is
+            "code", "string", "escape_string", "identifier", "line_comment", "comment" or
+            "dollar_string" """
+        context = "code"
+        # Nesting depth of block comments
+        depth = 0
+        # Closing delimiter of the dollar quoted string
+        dollarTag = None
+        i = 0
+        while i < len(template):
+            if context == "dollar_string" and template.startswith(dollarTag, i):
+                context = "code"
+                i += len(dollarTag)
+                continue
+            match = PLACEHOLDER_RE.match(template, i)
+            # Placeholders which are left unchanged open a dollar quoted string in code
+            if match and (context != "code" or match.group(1) in PLACEHOLDERS):
+                yield match.start(), match.end(), match.group(1), context
+                i = match.end()
+                continue
+            char = template[i]
+            pair = template[i:i + 2]
+            if context == "code":
+                if char == "'":
+                    escape = i > 0 and template[i - 1] in "eE" and not (
+                        i > 1 and (template[i - 2].isalnum() or template[i - 2] == "_"))
+                    context = "escape_string" if escape else "string"
+                elif char == '"':
+                    context = "identifier"
+                elif pair == "--":
+                    context = "line_comment"
+                    i += 1
+                elif pair == "/*":
+                    context = "comment"
+                    depth = 1
+                    i += 1
+                elif char == "$" and not (
+                        i > 0 and (template[i - 1].isalnum() or template[i - 1] in "_$")):
+                    # A $ following an identifier is part of it, i.e. in foo$bar$
+                    tag = DOLLAR_TAG_RE.match(template, i)
+                    if tag:
+                        context = "dollar_string"
+                        dollarTag = tag.group(0)
+                        i = tag.end()
+                        continue
+            elif context in ["string", "escape_string"]:
+                if context == "escape_string" and char == "\\":
+                    i += 1
+                elif pair == "''":
+                    i += 1
+                elif char == "'":
+                    context = "code"
+            elif context == "identifier":
+                if pair == '""':
+                    i += 1
+                elif char == '"':
+                    context = "code"
+            elif context == "line_comment":
+                if char == "\n":
+                    context = "code"
+            elif context == "comment":
+                if pair == "/*":
+                    depth += 1
+                    i += 1
+                elif pair == "*/":
+                    depth -= 1
+                    i += 1
+                    if depth == 0:
+                        context = "code"
+            i += 1
+
+    def render(self, values):
+        """ Returns the subset string with the placeholders replaced by values """
+        result = [self.parts[0]]
+        for (name, mode), part in zip(self.slots, self.parts[1:]):
+            value = values.get(name) or ""
+            if mode in ["escaped", "escaped_e"]:
+                result.append(sqlEscape(value, mode == "escaped_e"))
+            elif mode == "list":
+                items = ["'%s'" % sqlEscape(item) for item in value.split(",") if item]
+                result.append(", ".join(items) or "NULL")
+            else:
+                result.append("'%s'" % sqlEscape(value))
+            result.append(part)
+        return "".join(result)
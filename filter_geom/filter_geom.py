@@ -18,70 +18,515 @@ from qgis.core import *
 from qgis.server import *
 from qgis.PyQt.QtCore import QFile, QIODevice
 from qgis.PyQt.QtXml import QDomDocument
+from collections import OrderedDict
+import hashlib
+import json
+import math
 import os
+import re
+import time
+import uuid
+
+try:
+    from clear_capabilities.dependencies import dependencyRegistry
+except ImportError:
+    dependencyRegistry = None
+
+# SQL tokens used by the injected filter expressions
+SQL_TOKENS = [
+    "st_intersects", "st_geomfromwkb", "decode", "st_makeenvelope", "&&"
+]
+# Simplification tolerance of the filter geometry in pixels of the map resolution, 0 to disable
+SIMPLIFY_TOLERANCE_PX = float(os.getenv("FILTER_GEOM_SIMPLIFY_TOLERANCE_PX", "0"))
+# Number of stored filter geometries, and their time to live in seconds
+STORE_SIZE = int(os.getenv("FILTER_GEOM_STORE_SIZE", "100"))
+STORE_TTL = int(os.getenv("FILTER_GEOM_STORE_TTL", "3600"))
+# Directory shared by the server processes, in which stored filter geometries are kept
+STORE_DIR = os.getenv("FILTER_GEOM_STORE_DIR", "")
+# Maximum number of feature ids in the filter of a file based layer, larger filters are rejected
+MAX_FIDS = int(os.getenv("FILTER_GEOM_MAX_FIDS", "10000"))
+
+class FilterGeomError(Exception):
+    """ The filter geometry cannot be applied to a layer """
+
+def registerSqlTokens(serverIface):
+    """ Adds the SQL tokens used by FILTER_GEOM to QGIS_SERVER_ALLOWED_EXTRA_SQL_TOKENS """
+    extraTokens = [token.lower() for token in filter(bool, os.getenv("QGIS_SERVER_ALLOWED_EXTRA_SQL_TOKENS", "").split(","))]
+    changed = False
+    for token in SQL_TOKENS:
+        if not token in extraTokens:
+            extraTokens.append(token)
+            changed = True
+    if changed:
+        os.environ["QGIS_SERVER_ALLOWED_EXTRA_SQL_TOKENS"] = ",".join(extraTokens)
+        serverIface.reloadSettings()
+        QgsMessageLog.logMessage(
+            f"Altered QGIS_SERVER_ALLOWED_EXTRA_SQL_TOKENS to %s" % (",".join(extraTokens)), "FilterGeom", Qgis.MessageLevel.Info
+        )
+
+def projectLayerInfo(project):
+    """ Returns a map of WMS layer name -> (provider type, column, crs, layer id), where column is the
+        geometry column of postgis layers, and the feature id column of file based layers """
+    useLayerIds = QgsServerProjectUtils.wmsUseLayerIds(project)
+    layerInfo = {}
+    for layer in project.mapLayers().values():
+        layername = layer.shortName()
+        if useLayerIds:
+            layername = layer.id()
+        elif not layername:
+            layername = layer.name()
+
+        column = None
+        if layer.providerType() == "postgres":
+            column = QgsDataSourceUri(layer.source()).geometryColumn()
+        elif layer.providerType() == "ogr" and layer.type() == QgsMapLayerType.VectorLayer:
+            # GeoPackage fid column, or the OGR FID special field for i.e. shapefiles
+            pkIndexes = layer.dataProvider().pkAttributeIndexes()
+            column = layer.fields().at(pkIndexes[0]).name() if pkIndexes else "FID"
+        elif layer.providerType() == "spatialite":
+            column = QgsDataSourceUri(layer.source()).keyColumn() or "ROWID"
+        layerInfo[layername] = (layer.providerType(), column, layer.crs(), layer.id())
+    return layerInfo
+
+def mapResolution(request):
+    """ Returns the GetMap resolution in map units per pixel, or 0 if unknown """
+    try:
+        bbox = [float(value) for value in request.parameter('BBOX').split(",")]
+        width = int(request.parameter('WIDTH'))
+        height = int(request.parameter('HEIGHT'))
+        return min(abs(bbox[2] - bbox[0]) / width, abs(bbox[3] - bbox[1]) / height)
+    except (ValueError, IndexError, ZeroDivisionError):
+        return 0
+
+def requestExtent(request, crs, project):
+    """ Returns the BBOX of the request in crs, grown by the tile buffer of the project, or None if the
+        request has no valid BBOX """
+    try:
+        bbox = [float(value) for value in request.parameter('BBOX').split(",")]
+    except ValueError:
+        return None
+    if len(bbox) != 4:
+        return None
+    extent = QgsRectangle(*bbox)
+    if request.parameter('VERSION') == '1.3.0' and crs.hasAxisInverted():
+        extent.invert()
+    # Features outside of the BBOX are rendered into the tile buffer
+    extent.grow(QgsServerProjectUtils.wmsTileBuffer(project) * mapResolution(request))
+    return extent
+
+def transformExtent(extent, crs, destCrs, transformContext):
+    """ Returns extent transformed from crs to destCrs, or None if it cannot be transformed """
+    if extent is None or destCrs == crs:
+        return extent
+    try:
+        return QgsCoordinateTransform(crs, destCrs, transformContext).transformBoundingBox(extent)
+    except QgsCsException:
+        return None
+
+def layerPath(layer):
+    """ Returns the file of a file based layer, or None """
+    return QgsProviderRegistry.instance().decodeUri(layer.providerType(), layer.source()).get("path")
+
+def candidateFids(layer, rect, spatialIndex):
+    """ Returns the ids of the features whose bounding box intersects rect, looked up via the spatial
+        index of the layer (GeoPackage / SpatiaLite R-tree, shapefile .qix), or if the layer has none,
+        via the given QgsSpatialIndex """
+    if spatialIndex is not None:
+        return spatialIndex.intersects(rect)
+    request = QgsFeatureRequest().setFilterRect(rect).setNoAttributes()
+    return [feature.id() for feature in layer.getFeatures(request)]
+
+def intersectingFids(layer, geometry, rect, spatialIndex):
+    """ Returns the ids of the features within rect which intersect geometry """
+    engine = QgsGeometry.createGeometryEngine(geometry.constGet())
+    engine.prepareGeometry()
+    if spatialIndex is not None:
+        request = QgsFeatureRequest().setFilterFids(spatialIndex.intersects(rect)).setNoAttributes()
+    else:
+        request = QgsFeatureRequest().setFilterRect(rect).setNoAttributes()
+    return [
+        feature.id() for feature in layer.getFeatures(request)
+        if feature.hasGeometry() and engine.intersects(feature.geometry().constGet())
+    ]
+
+def crsKey(crs):
+    """ Returns a string identifying crs """
+    return crs.authid() or crs.toWkt()
+
+class FilterGeometry:
+    """ FILTER_GEOM geometry, reprojected and simplified once per layer srid.
+
+    The simplification tolerance is given in units of toleranceCrs, i.e. the request CRS, and
+    converted to the units of the layer CRS after reprojecting the geometry.
+    """
+
+    def __init__(self, geometry, crs, transformContext, tolerance, toleranceCrs):
+        self.crs = crs
+        self.transformContext = transformContext
+        self.geometry = geometry
+        self.tolerance = tolerance
+        self.toleranceCrs = toleranceCrs
+        # Layer crs -> (geometry, bounding box, hex WKB) in the layer crs
+        self.__transformed = {}
+
+    def postgisExpression(self, geomColumn, layerCrs):
+        """ Returns the filter expression for a postgis layer """
+        layerSrid = layerCrs.postgisSrid()
+        geometry, bbox, wkbHex = self.transformed(layerCrs)
+        return "\"%s\" && ST_MakeEnvelope ( %r , %r , %r , %r , %d ) AND ST_Intersects ( \"%s\" , ST_GeomFromWKB ( decode ( '%s' , 'hex' ) , %d ) )" % (
+            geomColumn, bbox.xMinimum(), bbox.yMinimum(), bbox.xMaximum(), bbox.yMaximum(), layerSrid,
+            geomColumn, wkbHex, layerSrid
+        )
+
+    def fileLayerExpression(self, layer, fidColumn, spatialIndex, extent, cachedFids=None):
+        """ Returns the filter expression for a file based layer, which selects the ids of the
+            features intersecting the geometry within extent, the request BBOX in the layer crs or
+            None. cachedFids are the ids of all intersecting features, if they are known. Raises
+            FilterGeomError if more than MAX_FIDS features are selected """
+        geometry, bbox, wkbHex = self.transformed(layer.crs())
+        if extent is not None:
+            if not bbox.intersects(extent):
+                return "\"%s\" = -1" % fidColumn
+            bbox = bbox.intersect(extent)
+
+        if cachedFids is not None:
+            fids = [fid for fid in candidateFids(layer, bbox, spatialIndex) if fid in cachedFids]
+        else:
+            fids = intersectingFids(layer, geometry, bbox, spatialIndex)
+        if len(fids) > MAX_FIDS:
+            raise FilterGeomError(
+                'FILTER_GEOM selects more than %d features of layer %s' % (MAX_FIDS, layer.name())
+            )
+        if not fids:
+            return "\"%s\" = -1" % fidColumn
+        return "\"%s\" IN ( %s )" % (fidColumn, " , ".join(map(str, sorted(fids))))
+
+    def transformed(self, layerCrs):
+        """ Returns the geometry, its bounding box and hex WKB in layerCrs, raises FilterGeomError
+            if the geometry cannot be reprojected """
+        key = crsKey(layerCrs)
+        if key not in self.__transformed:
+            self.__transformed[key] = self.transform(layerCrs)
+        if self.__transformed[key] is None:
+            raise FilterGeomError('FILTER_GEOM cannot be transformed to %s' % key)
+        return self.__transformed[key]
+
+    def transform(self, layerCrs):
+        geometry = QgsGeometry(self.geometry)
+        if layerCrs != self.crs:
+            try:
+                transform = QgsCoordinateTransform(self.crs, layerCrs, self.transformContext)
+                if geometry.transform(transform) != Qgis.GeometryOperationResult.Success:
+                    return None
+            except QgsCsException:
+                return None
+        if self.tolerance > 0:
+            simplified = geometry.simplify(self.layerTolerance(geometry, layerCrs))
+            if not simplified.isEmpty():
+                geometry = simplified
+        return geometry, geometry.boundingBox(), bytes(geometry.asWkb().toHex()).decode()
+
+    def layerTolerance(self, geometry, layerCrs):
+        """ Returns the simplification tolerance in units of layerCrs, measured at the center of
+            the geometry given in layerCrs, or 0 if it cannot be converted """
+        if not self.toleranceCrs.isValid() or layerCrs == self.toleranceCrs:
+            return self.tolerance
+        try:
+            transform = QgsCoordinateTransform(layerCrs, self.toleranceCrs, self.transformContext)
+            center = transform.transform(geometry.boundingBox().center())
+            rect = QgsRectangle(
+                center.x() - self.tolerance / 2, center.y() - self.tolerance / 2,
+                center.x() + self.tolerance / 2, center.y() + self.tolerance / 2
+            )
+            rect = transform.transformBoundingBox(rect, Qgis.TransformDirection.Reverse)
+        except QgsCsException:
+            return 0
+        return min(rect.width(), rect.height())
+
+class StoredFilterGeometry:
+    """ Filter geometry stored in the FilterGeomStore, with its preprocessed forms """
+
+    def __init__(self, wkt, crs, geometry):
+        self.wkt = wkt
+        self.crs = crs
+        self.geometry = geometry
+        self.timestamp = time.time()
+        # (project path, tolerance, tolerance crs) -> FilterGeometry
+        self.__filterGeometries = OrderedDict()
+        # (project path, layer id, mtime of the layer file) -> ids of the intersecting features
+        self.__fids = OrderedDict()
+
+    def filterGeometry(self, projectPath, project, tolerance, toleranceCrs):
+        """ Returns the FilterGeometry for the project and simplification tolerance in units of
+            toleranceCrs. The tolerance is rounded down to a power of two, so that requests at the
+            same scale share it """
+        if tolerance > 0:
+            tolerance = 2 ** math.floor(math.log2(tolerance))
+        key = (projectPath, tolerance, crsKey(toleranceCrs) if tolerance > 0 else None)
+        if key in self.__filterGeometries:
+            self.__filterGeometries.move_to_end(key)
+        else:
+            self.__filterGeometries[key] = FilterGeometry(
+                self.geometry, self.crs, project.transformContext(), tolerance, toleranceCrs
+            )
+            while len(self.__filterGeometries) > 8:
+                self.__filterGeometries.popitem(last=False)
+        return self.__filterGeometries[key]
+
+    def intersectingFids(self, projectPath, project, layer, spatialIndex):
+        """ Returns the ids of all features of the file based layer which intersect the geometry.
+            They are looked up once per layer and modification of its file, with the unsimplified
+            geometry, so that the requests of all tiles only need a spatial index lookup """
+        path = layerPath(layer)
+        key = (projectPath, layer.id(), os.path.getmtime(path) if path and os.path.exists(path) else None)
+        if key in self.__fids:
+            self.__fids.move_to_end(key)
+        else:
+            exact = self.filterGeometry(projectPath, project, 0, self.crs)
+            geometry, bbox, wkbHex = exact.transformed(layer.crs())
+            self.__fids[key] = frozenset(intersectingFids(layer, geometry, bbox, spatialIndex))
+            while len(self.__fids) > 16:
+                self.__fids.popitem(last=False)
+        return self.__fids[key]
+
+class FilterGeomStore:
+    """ Bounded store of filter geometries, keyed by the hash of their content.
+
+    If storeDir is set, geometries are also written to the directory, so that all server processes
+    sharing it can resolve the ids. The modification time of the files is refreshed on use, and
+    files unused for longer than the time to live are removed.
+    """
+
+    def __init__(self, size, ttl, storeDir=""):
+        self.size = size
+        self.ttl = ttl
+        self.storeDir = storeDir
+        if storeDir:
+            os.makedirs(storeDir, exist_ok=True)
+        self.__entries = OrderedDict()
+
+    def add(self, wkt, crs):
+        """ Stores the geometry and returns its id, or None if the WKT is invalid """
+        geometry = QgsGeometry.fromWkt(wkt)
+        if geometry.isNull():
+            return None
+        geomId = hashlib.sha256((crsKey(crs) + "\n" + wkt).encode()).hexdigest()[:32]
+        if geomId in self.__entries:
+            self.__entries.move_to_end(geomId)
+            self.__entries[geomId].timestamp = time.time()
+        else:
+            self.__entries[geomId] = StoredFilterGeometry(wkt, crs, geometry)
+            while len(self.__entries) > self.size:
+                self.__entries.popitem(last=False)
+        if self.storeDir:
+            self.write(geomId, wkt, crs)
+            self.removeExpired()
+        return geomId
+
+    def get(self, geomId):
+        """ Returns the StoredFilterGeometry, or None if it is unknown or expired """
+        if not re.fullmatch(r"[0-9a-f]{32}", geomId):
+            return None
+        entry = self.__entries.get(geomId)
+        if entry is not None and time.time() - entry.timestamp > self.ttl:
+            # Other processes may have used the geometry in the meantime
+            del self.__entries[geomId]
+            entry = None
+        if entry is None and self.storeDir:
+            entry = self.read(geomId)
+            if entry is not None:
+                self.__entries[geomId] = entry
+                while len(self.__entries) > self.size:
+                    self.__entries.popitem(last=False)
+        if entry is None:
+            return None
+        entry.timestamp = time.time()
+        self.touch(geomId)
+        self.__entries.move_to_end(geomId)
+        return entry
+
+    def path(self, geomId):
+        return os.path.join(self.storeDir, geomId + ".wkt")
+
+    def write(self, geomId, wkt, crs):
+        tmpPath = self.path(geomId) + "." + uuid.uuid4().hex + ".tmp"
+        with open(tmpPath, "w") as fh:
+            fh.write(crs.toWkt() + "\n" + wkt)
+        # Rename is atomic, other processes never read partially written files
+        os.replace(tmpPath, self.path(geomId))
+
+    def read(self, geomId):
+        """ Returns the StoredFilterGeometry of the geometry in the store directory, or None """
+        try:
+            if time.time() - os.path.getmtime(self.path(geomId)) > self.ttl:
+                return None
+            with open(self.path(geomId)) as fh:
+                crsWkt, wkt = fh.read().split("\n", 1)
+        except (OSError, ValueError):
+            return None
+        geometry = QgsGeometry.fromWkt(wkt)
+        crs = QgsCoordinateReferenceSystem.fromWkt(crsWkt)
+        if geometry.isNull() or not crs.isValid():
+            return None
+        return StoredFilterGeometry(wkt, crs, geometry)
+
+    def touch(self, geomId):
+        """ Marks the geometry in the store directory as used """
+        if not self.storeDir:
+            return
+        try:
+            os.utime(self.path(geomId))
+        except OSError:
+            pass
+
+    def removeExpired(self):
+        expired = time.time() - self.ttl
+        try:
+            entries = list(os.scandir(self.storeDir))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime < expired:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+class FilterGeomService(QgsService):
+    """ Stores filter geometries POSTed as WKT (in the body or the FILTER_GEOM parameter) in the CRS
+        given by the CRS parameter, and returns the FILTER_GEOM_ID to reference them """
+
+    def __init__(self, store):
+        QgsService.__init__(self)
+        self.store = store
+
+    def name(self):
+        return "FilterGeom"
+
+    def version(self):
+        return "1.0.0"
+
+    def executeRequest(self, request, response, project):
+        params = request.parameters()
+        try:
+            wkt = params.get("FILTER_GEOM") or bytes(request.data()).decode()
+        except UnicodeDecodeError:
+            wkt = ""
+        crs = QgsCoordinateReferenceSystem(params.get("CRS", ""))
+
+        response.setHeader('Content-Type', 'application/json; charset=utf-8')
+        geomId = self.store.add(wkt.strip(), crs) if wkt and crs.isValid() else None
+        if geomId is None:
+            response.setStatusCode(400)
+            response.write(json.dumps({"error": "Invalid geometry or CRS"}))
+        else:
+            response.write(json.dumps({"id": geomId}))
 
 class FilterGeomFilter(QgsServerFilter):
-    def __init__(self, serverIface):
+    def __init__(self, serverIface, store):
         super(FilterGeomFilter, self).__init__(serverIface)
-        self.__layouts = []
-        self.__project = None
-        
+        self.__store = store
+        # Project path -> layer info, see projectLayerInfo
+        self.__layerInfo = {}
+        # Project path -> {layer id: QgsSpatialIndex} of file based layers without spatial index
+        self.__spatialIndexes = {}
+
     def onRequestReady(self):
         
         # Only apply FILTER_GEOM to GetMap and GetLegendGraphics. GetFeatureInfo already honours it
         request = self.serverInterface().requestHandler()
         requestParam = request.parameter('REQUEST').upper()
         filterGeomParam = request.parameter('FILTER_GEOM')
+        filterGeomId = request.parameter('FILTER_GEOM_ID')
         filterParam = request.parameter('FILTER')
         layersParam = request.parameter('LAYERS').split(",")
         crsParam = request.parameter('SRS')
         if not crsParam:
             crsParam = request.parameter('CRS')
-        srid = crsParam[5:]
-        if not requestParam in ['GETMAP', 'GETLEGENDGRAPHICS', 'GETPRINT'] or not filterGeomParam:
-            return True
 
-        # Inject st_intersects and st_geomfromtext tokens if necessary
-        extraTokens = [token.lower() for token in filter(bool, os.getenv("QGIS_SERVER_ALLOWED_EXTRA_SQL_TOKENS", "").split(","))]
-        changed = False
-        for token in ["st_intersects", "st_geomfromtext", "st_transform"]:
-            if not token in extraTokens:
-                extraTokens.append(token)
-                changed = True
-        if changed:
-            os.environ["QGIS_SERVER_ALLOWED_EXTRA_SQL_TOKENS"] = ",".join(extraTokens)
-            self.serverInterface().reloadSettings()
-            QgsMessageLog.logMessage(
-                f"Altered QGIS_SERVER_ALLOWED_EXTRA_SQL_TOKENS to %s" % (",".join(extraTokens)), "FilterGeom", Qgis.MessageLevel.Info
-            )
+        storedGeometry = None
+        if filterGeomId:
+            storedGeometry = self.__store.get(filterGeomId)
+            if storedGeometry is None:
+                request.setServiceException(QgsServiceException(
+                    'InvalidParameterValue', 'Unknown or expired FILTER_GEOM_ID %s' % filterGeomId, '', 400
+                ))
+                return True
+            request.removeParameter('FILTER_GEOM_ID')
+            if requestParam == 'GETFEATUREINFO':
+                # GetFeatureInfo honours FILTER_GEOM, in the request CRS
+                try:
+                    project = QgsConfigCache.instance().project(self.serverInterface().configFilePath())
+                except:
+                    return True
+                if not project:
+                    return True
+                wkt = self.transformedWkt(storedGeometry, QgsCoordinateReferenceSystem(crsParam), project)
+                if wkt is None:
+                    request.setServiceException(QgsServiceException(
+                        'InvalidParameterValue', 'FILTER_GEOM_ID cannot be transformed to %s' % crsParam, '', 400
+                    ))
+                    return True
+                request.setParameter('FILTER_GEOM', wkt)
+                return True
+
+        if not requestParam in ['GETMAP', 'GETLEGENDGRAPHICS', 'GETPRINT'] or not (filterGeomParam or storedGeometry):
+            return True
 
         projectPath = self.serverInterface().configFilePath()
         try:
             project = QgsConfigCache.instance().project(projectPath)
         except:
             return True
+        layerInfo = self.__layerInfo.get(projectPath)
+        if layerInfo is None:
+            layerInfo = projectLayerInfo(project)
+            self.__layerInfo[projectPath] = layerInfo
+            self.__spatialIndexes[projectPath] = {}
+            # Collect the layer info again once the project is removed from the config cache
+            project.destroyed.connect(lambda: self.dropProject(projectPath))
         filters = dict(map(lambda entry: entry.split(":"), filter(bool, filterParam.split(";"))))
 
-        # Append geometry filter expression to all postgis layers
-        for layer in project.mapLayers().values():
-
-            layername = layer.shortName()
-            if QgsServerProjectUtils.wmsUseLayerIds(project):
-                layername = layer.id()
-            elif not layername:
-                layername = layer.name()
+        tolerance = 0
+        if SIMPLIFY_TOLERANCE_PX > 0 and requestParam == 'GETMAP':
+            tolerance = SIMPLIFY_TOLERANCE_PX * mapResolution(request)
+        requestCrs = QgsCoordinateReferenceSystem(crsParam)
+        extent = requestExtent(request, requestCrs, project) if requestParam in ['GETMAP', 'GETLEGENDGRAPHICS'] else None
+        if storedGeometry:
+            filterGeometry = storedGeometry.filterGeometry(projectPath, project, tolerance, requestCrs)
+        else:
+            geometry = QgsGeometry.fromWkt(filterGeomParam)
+            if geometry.isNull():
+                request.setServiceException(QgsServiceException(
+                    'InvalidParameterValue', 'Invalid FILTER_GEOM', '', 400
+                ))
+                return True
+            filterGeometry = FilterGeometry(geometry, requestCrs, project.transformContext(), tolerance, requestCrs)
 
-            if not layername in layersParam:
+        # Append geometry filter expression to all requested postgis and file based layers
+        for layername in dict.fromkeys(layersParam):
+            if not layername in layerInfo:
                 continue
+            providerType, column, layerCrs, layerId = layerInfo[layername]
 
             filterExpr = None
-            if layer.providerType() == "postgres":
-                geomColumn = QgsDataSourceUri(layer.source()).geometryColumn()
-                filterExpr = "ST_Intersects ( \"%s\" , ST_Transform ( ST_GeomFromText ( '%s' , %s ) , %d ) )" % (geomColumn, filterGeomParam, srid, layer.crs().postgisSrid())
-            # elif layer.providerType() == "ogr" and layer.source().split("|")[0].lower().endswith(".gpkg"):
-            #     tablename = layer.source().split('layername=')[-1]
-            #     geomColumn = QgsMapLayerUtils.databaseConnection(layer).table('', tablename).geometryColumn()
-            #     filterExpr = "ST_Intersects ( \"%s\" , ST_GeomFromText ( '%s' , %s ) )" % (geomColumn, filterGeomParam, srid)
+            try:
+                if providerType == "postgres":
+                    filterExpr = filterGeometry.postgisExpression(column, layerCrs)
+                elif column and providerType in ["ogr", "spatialite"]:
+                    layer = project.mapLayer(layerId)
+                    spatialIndex = self.spatialIndex(projectPath, layer)
+                    cachedFids = None
+                    if storedGeometry:
+                        cachedFids = storedGeometry.intersectingFids(projectPath, project, layer, spatialIndex)
+                    filterExpr = filterGeometry.fileLayerExpression(
+                        layer, column, spatialIndex,
+                        transformExtent(extent, requestCrs, layerCrs, project.transformContext()), cachedFids
+                    )
+            except FilterGeomError as e:
+                # Never render the layer unfiltered
+                request.setServiceException(QgsServiceException('InvalidParameterValue', str(e), '', 400))
+                return True
 
             if filterExpr:
                 if layername in filters:
@@ -104,9 +549,45 @@ class FilterGeomFilter(QgsServerFilter):
             prefix = self.get_map_param_prefix(request.parameterMap())
             request.setParameter(prefix + ':FILTER', newFilter)
             request.removeParameter(prefix + ':FILTER_GEOM')
+            request.removeParameter(prefix + ':FILTER_GEOM_ID')
 
         return True
 
+    def transformedWkt(self, storedGeometry, crs, project):
+        """ Returns the WKT of the stored geometry in crs, using the transformations of the project,
+            or None if it cannot be transformed """
+        geometry = QgsGeometry(storedGeometry.geometry)
+        if crs.isValid() and crs != storedGeometry.crs:
+            try:
+                transform = QgsCoordinateTransform(storedGeometry.crs, crs, project.transformContext())
+                if geometry.transform(transform) != Qgis.GeometryOperationResult.Success:
+                    return None
+            except QgsCsException:
+                return None
+        return geometry.asWkt()
+
+    def spatialIndex(self, projectPath, layer):
+        """ Returns the in-memory spatial index of a file based layer without spatial index, which is
+            built on first use and dropped once the file of the layer changes, or None """
+        if layer.hasSpatialIndex() != QgsFeatureSource.SpatialIndexPresence.SpatialIndexNotPresent:
+            return None
+        spatialIndexes = self.__spatialIndexes[projectPath]
+        if layer.id() not in spatialIndexes:
+            spatialIndexes[layer.id()] = QgsSpatialIndex(layer.getFeatures(QgsFeatureRequest().setNoAttributes()))
+            path = layerPath(layer)
+            if dependencyRegistry and path:
+                dependencyRegistry().add(path, ("filter_geom", projectPath, layer.id()), self.dropSpatialIndex)
+        return spatialIndexes[layer.id()]
+
+    def dropSpatialIndex(self, key):
+        self.__spatialIndexes.get(key[1], {}).pop(key[2], None)
+
+    def dropProject(self, projectPath):
+        self.__layerInfo.pop(projectPath, None)
+        for layerId in self.__spatialIndexes.pop(projectPath, {}):
+            if dependencyRegistry:
+                dependencyRegistry().remove(("filter_geom", projectPath, layerId))
+
     def get_map_param_prefix(self, params):
         # Deduce map name by looking for param which ends with :EXTENT
         # (Can't look for param ending with :LAYERS as there might be i.e. A:LAYERS for the external layer definition A)
@@ -119,4 +600,7 @@ class FilterGeomFilter(QgsServerFilter):
 class FilterGeom:
     def __init__(self, serverIface):
         self.iface = serverIface
-        serverIface.registerFilter(FilterGeomFilter(serverIface))
+        registerSqlTokens(serverIface)
+        store = FilterGeomStore(STORE_SIZE, STORE_TTL, STORE_DIR)
+        serverIface.registerFilter(FilterGeomFilter(serverIface, store))
+        serverIface.serviceRegistry().registerService(FilterGeomService(store))
@@ -1,9 +1,44 @@
 from qgis.core import *
 from qgis.server import *
+from qgis.PyQt.QtCore import QByteArray, qgetenv
+from collections import OrderedDict
+import gzip
+import hashlib
 import json
 import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from xml.etree import ElementTree
 
+try:
+    from clear_capabilities.dependencies import dependencyRegistry
+except ImportError:
+    dependencyRegistry = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Number of cached translation bundles per project
+CACHE_SIZE = int(os.getenv("GET_TRANSLATIONS_CACHE_SIZE", "64"))
+# Language codes of translation files, i.e. de, de_CH, pt-BR
+LANG_RE = re.compile(r"[a-z]{2,3}([_-][A-Za-z0-9]+)?")
+# Number of threads compiling translations in the background
+COMPILE_THREADS = max(1, int(os.getenv("GET_TRANSLATIONS_COMPILE_THREADS", "2")))
+
+# Content encodings, in order of preference
+ENCODERS = OrderedDict()
+if brotli:
+    ENCODERS["br"] = lambda body: brotli.compress(body, quality=11)
+if zstandard:
+    ENCODERS["zstd"] = lambda body: zstandard.ZstdCompressor(level=19).compress(body)
+ENCODERS["gzip"] = lambda body: gzip.compress(body, compresslevel=9, mtime=0)
+
 def deep_merge(d1, d2):
     """Recursively merge two dictionaries."""
     result = d1.copy()
@@ -18,10 +53,119 @@ def deep_merge(d1, d2):
             result[k] = v
     return result
 
+def mtime(path):
+    """ Returns the modification time of path, or None if it does not exist """
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def negotiateEncoding(acceptEncoding, available):
+    """ Returns the preferred content encoding of the available ones accepted by the Accept-Encoding
+        header value, or None for identity """
+    accepted = {}
+    for entry in filter(bool, map(str.strip, acceptEncoding.lower().split(","))):
+        parts = entry.split(";")
+        quality = 1.
+        for param in parts[1:]:
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.
+        accepted[parts[0].strip()] = quality
+
+    encodings = [
+        encoding for encoding in ENCODERS
+        if encoding in available and accepted.get(encoding, accepted.get("*", 0.)) > 0
+    ]
+    if not encodings:
+        return None
+    # Highest quality first, ties are broken by the server preference
+    return max(encodings, key=lambda encoding: accepted.get(encoding, accepted.get("*", 0.)))
+
+def requestHeader(request, name):
+    """ Returns the value of a request header, or an empty string. The lookup is case-insensitive,
+        and falls back to the HTTP_<NAME> CGI variable, as the FCGI server only copies a few known
+        headers into the request """
+    for key, value in request.headers().items():
+        if key.lower() == name.lower() and value:
+            return value
+    # The FCGI library sets the environment of each request, read it through getenv()
+    return bytes(qgetenv("HTTP_" + name.upper().replace("-", "_"))).decode("latin-1")
+
+def etagMatches(ifNoneMatch, etag):
+    """ Checks whether the If-None-Match header value matches etag """
+    tags = [tag.strip() for tag in ifNoneMatch.split(",")]
+    return "*" in tags or etag in tags or "W/" + etag in tags
+
+def addContextTranslations(translations, context, names):
+    """ Adds the translations of a TS context element to translations """
+    context_name = context.find('./name')
+    if context_name is None or not context_name.text:
+        return
+
+    context_name_parts = context_name.text.split(":")
+    key = None
+    if len(context_name_parts) >= 3 and context_name_parts[0] == "project" and context_name_parts[1] == "layers":
+        # replace layer id with layer name
+        layername = names.get(context_name_parts[2])
+        if layername is None:
+            return
+
+        if len(context_name_parts) == 3:
+            ts_path = ["layertree"]
+            key = layername
+        elif len(context_name_parts) == 4 and context_name_parts[3] == "fieldaliases":
+            ts_path = ["layers", layername, "fields"]
+        elif len(context_name_parts) == 4 and context_name_parts[3] == "formcontainers":
+            ts_path = ["layers", layername, "form"]
+        else:
+            return
+    elif len(context_name_parts) == 2 and context_name_parts[0] == "project" and context_name_parts[1] == "layergroups":
+        ts_path = ["layertree"]
+    else:
+        # Unknown ts context
+        return
+
+    context_ts = translations
+    for entry in ts_path:
+        context_ts = context_ts.setdefault(entry, {})
+
+    for message in context.iterfind("./message"):
+        source = message.find('./source')
+        translation = message.find('./translation')
+        if source is not None and translation is not None and translation.get('type', '') != "unfinished":
+            context_ts[key or source.text] = translation.text
+
+def layerNames(project):
+    """ Returns a map of layer id -> layer name as used in the translations """
+    names = {}
+    for layer in project.mapLayers().values():
+        try:
+            names[layer.id()] = layer.serverProperties().shortName() or layer.name()
+        except AttributeError:
+            names[layer.id()] = layer.shortName() or layer.name()
+    return names
+
 class GetTranslationsService(QgsService):
     def __init__(self, serverIface):
         QgsService.__init__(self)
         self.serverIface = serverIface
+        # (project file, lang) -> (key, {encoding: body}, etag), see bundle
+        self.cache = OrderedDict()
+        # Guards the cache and pending, which are filled by the compile threads
+        self.lock = threading.Lock()
+        # (project file, lang) -> (key, future) of bundles being compiled in the background
+        self.pending = {}
+        # Project file -> modification time of the project when its languages were compiled
+        self.compiled = {}
+        # Project file -> (modification time, layer id -> layer name map)
+        self.layerNames = {}
+        # Cache keys evicted by the compile threads, whose dependencies are not yet unregistered
+        self.evicted = []
+        self.executor = ThreadPoolExecutor(max_workers=COMPILE_THREADS)
 
     def name(self):
         return "GetTranslations"
@@ -31,68 +175,230 @@ class GetTranslationsService(QgsService):
 
     def executeRequest(self, request, response, project):
         params = request.parameters()
+        self.releaseEvicted()
 
         lang = params.get("LANG", "en")
         QgsMessageLog.logMessage('Lang is %s' % lang, "[GetTranslationsService]", Qgis.Info)
         projectfile = params.get("MAP", os.environ.get("QGIS_PROJECT_FILE"))
         QgsMessageLog.logMessage('Project %s' % projectfile, "[GetTranslationsService]", Qgis.Info)
 
-        dirname = os.path.dirname(projectfile)
-        filename = os.path.splitext(os.path.basename(projectfile))
+        if params.get("REQUEST", "").upper() == "COMPILE":
+            langs = self.compileAll(projectfile, project)
+            response.setHeader('Content-Type', 'application/json; charset=utf-8')
+            response.write(json.dumps({"languages": langs}))
+            return
 
-        # Handle "GetTranslations" request
-        QgsMessageLog.logMessage('Looking for *.ts translation files', "[GetTranslationsService]", Qgis.Info)
+        # Compile the other languages of the project in the background
+        if self.compiled.get(projectfile) != mtime(projectfile):
+            self.compileAll(projectfile, project)
+
+        langs = list(filter(bool, map(str.strip, lang.split(",")))) or [lang]
+        # Only valid language codes are looked up, so that clients cannot register arbitrary paths
+        invalid = [lang for lang in langs if not LANG_RE.fullmatch(lang)]
+        if invalid:
+            response.setStatusCode(400)
+            response.setHeader('Content-Type', 'application/json; charset=utf-8')
+            response.write(json.dumps({"error": "Invalid LANG: %s" % ",".join(invalid)}))
+            return
+        if len(langs) == 1:
+            bodies, etag = self.bundle(projectfile, project, langs[0])
+        else:
+            bodies, etag = self.batchBundle(projectfile, project, langs)
+
+        # Compressed variants are built by the compile threads, until they are ready the
+        # translations are served uncompressed
+        with self.lock:
+            available = list(bodies)
+        encoding = negotiateEncoding(requestHeader(request, 'Accept-Encoding'), available)
+        # Each encoding is a separate representation with its own strong ETag
+        etag = '"%s-%s"' % (etag, encoding) if encoding else '"%s"' % etag
+
+        response.setHeader('Vary', 'Accept-Encoding')
+        response.setHeader('ETag', etag)
+        if etagMatches(requestHeader(request, 'If-None-Match'), etag):
+            response.setStatusCode(304)
+            return
 
         response.setHeader('Content-Type', 'application/json; charset=utf-8')
+        if encoding:
+            response.setHeader('Content-Encoding', encoding)
+        response.write(QByteArray(bodies[encoding]))
+
+    def translationFiles(self, projectfile, lang):
+        """ Returns the TS and JSON translation files of the project for lang, and the cache key of
+            the bundle, which is valid as long as the translation and project files are unchanged """
+        dirname = os.path.dirname(projectfile)
+        filename = os.path.splitext(os.path.basename(projectfile))
 
-        translations = {}
         ts_file = os.path.join(dirname, f"{filename[0]}_{lang}.ts")
         if not os.path.exists(ts_file):
             ts_file = os.path.join(dirname, f"{filename[0]}_{lang[0:2]}.ts")
+        json_file = os.path.join(dirname, f"{filename[0]}_{lang}.json")
+        if not os.path.exists(json_file):
+            json_file = os.path.join(dirname, f"{filename[0]}_{lang[0:2]}.json")
+
+        key = (ts_file, mtime(ts_file), json_file, mtime(json_file), mtime(projectfile))
+        return ts_file, json_file, key
+
+    def bundle(self, projectfile, project, lang):
+        """ Returns the encoded bodies and the etag of the translations of the project for lang """
+        ts_file, json_file, key = self.translationFiles(projectfile, lang)
+        with self.lock:
+            entry = self.cache.get((projectfile, lang))
+            if entry is not None and entry[0] == key:
+                self.cache.move_to_end((projectfile, lang))
+                return entry[1:]
+            pending = self.pending.get((projectfile, lang))
+
+        if pending is not None and pending[0] == key:
+            # Wait for the background compilation instead of parsing the files again
+            return pending[1].result()[1:]
+
+        self.registerDependencies(projectfile, lang, ts_file, json_file)
+        return self.compile(projectfile, lang, self.projectLayerNames(projectfile, project), ts_file, json_file, key)[1:]
+
+    def batchBundle(self, projectfile, project, langs):
+        """ Returns the encoded bodies and the etag of the translations for multiple languages, as
+            object with the languages as keys """
+        entries = [self.bundle(projectfile, project, lang) for lang in langs]
+        key = tuple(etag for bodies, etag in entries)
+        with self.lock:
+            entry = self.cache.get((projectfile, ",".join(langs)))
+            if entry is not None and entry[0] == key:
+                return entry[1:]
+
+        body = b"{" + b", ".join(
+            json.dumps(lang).encode('utf-8') + b": " + bodies[None]
+            for lang, (bodies, etag) in zip(langs, entries)
+        ) + b"}"
+        entry = (key, {None: body}, hashlib.sha1(body).hexdigest())
+        self.store((projectfile, ",".join(langs)), entry)
+        self.executor.submit(self.encode, entry[1])
+        return entry[1:]
+
+    def compileAll(self, projectfile, project):
+        """ Compiles the translations of all languages of the project in the background, and
+            returns the languages """
+        self.compiled[projectfile] = mtime(projectfile)
+        dirname = os.path.dirname(projectfile)
+        prefix = os.path.splitext(os.path.basename(projectfile))[0] + "_"
+        try:
+            filenames = os.listdir(dirname)
+        except OSError:
+            return []
+        # Translations of other projects whose name starts with the same prefix, i.e. foo_bar_de.ts
+        # of foo_bar.qgs next to foo.qgs
+        otherPrefixes = [
+            os.path.splitext(filename)[0] + "_" for filename in filenames
+            if os.path.splitext(filename)[1].lower() in [".qgs", ".qgz"]
+            and filename.startswith(prefix) and os.path.splitext(filename)[0] + "_" != prefix
+        ]
+        langs = sorted(set(
+            os.path.splitext(filename)[0][len(prefix):] for filename in filenames
+            if filename.startswith(prefix) and os.path.splitext(filename)[1] in [".ts", ".json"]
+            and not any(filename.startswith(otherPrefix) for otherPrefix in otherPrefixes)
+            and LANG_RE.fullmatch(os.path.splitext(filename)[0][len(prefix):])
+        ))
+        if len(langs) > CACHE_SIZE:
+            QgsMessageLog.logMessage('Project %s has more languages than GET_TRANSLATIONS_CACHE_SIZE, compiling the first %d' % (projectfile, CACHE_SIZE), "[GetTranslationsService]", Qgis.Warning)
+            langs = langs[:CACHE_SIZE]
+
+        names = self.projectLayerNames(projectfile, project)
+        for lang in langs:
+            ts_file, json_file, key = self.translationFiles(projectfile, lang)
+            with self.lock:
+                entry = self.cache.get((projectfile, lang))
+                pending = self.pending.get((projectfile, lang))
+                if (entry is not None and entry[0] == key) or (pending is not None and pending[0] == key):
+                    continue
+                future = self.executor.submit(self.compile, projectfile, lang, names, ts_file, json_file, key)
+                self.pending[(projectfile, lang)] = (key, future)
+            self.registerDependencies(projectfile, lang, ts_file, json_file)
+
+        QgsMessageLog.logMessage('Compiling translations %s of %s' % (",".join(langs), projectfile), "[GetTranslationsService]", Qgis.Info)
+        return langs
+
+    def projectLayerNames(self, projectfile, project):
+        """ Returns the layer id -> layer name map of the project, built once per project version """
+        projectMtime = mtime(projectfile)
+        entry = self.layerNames.get(projectfile)
+        if entry is None or entry[0] != projectMtime:
+            entry = (projectMtime, layerNames(project))
+            self.layerNames[projectfile] = entry
+        return entry[1]
+
+    def compile(self, projectfile, lang, names, ts_file, json_file, key):
+        """ Builds and caches the bundle of the project for lang, returns the cache entry """
+        try:
+            body = json.dumps(self.buildTranslations(names, ts_file, json_file)).encode('utf-8')
+            entry = (key, {None: body}, hashlib.sha1(body).hexdigest())
+            self.store((projectfile, lang), entry)
+            self.executor.submit(self.encode, entry[1])
+            return entry
+        finally:
+            with self.lock:
+                pending = self.pending.get((projectfile, lang))
+                if pending is not None and pending[0] == key:
+                    del self.pending[(projectfile, lang)]
+
+    def encode(self, bodies):
+        """ Adds the compressed variants of the uncompressed body to bodies """
+        for encoding, encoder in ENCODERS.items():
+            try:
+                body = encoder(bodies[None])
+            except Exception as e:
+                QgsMessageLog.logMessage('Failed to encode translations as %s: %s' % (encoding, str(e)), "[GetTranslationsService]", Qgis.Warning)
+                continue
+            with self.lock:
+                bodies[encoding] = body
+
+    def store(self, cacheKey, entry):
+        """ Caches the bundle, and evicts the least recently used bundles of the same project """
+        with self.lock:
+            self.cache[cacheKey] = entry
+            self.cache.move_to_end(cacheKey)
+            projectKeys = [key for key in self.cache if key[0] == cacheKey[0]]
+            for key in projectKeys[:max(0, len(projectKeys) - CACHE_SIZE)]:
+                del self.cache[key]
+                # The registry is only used by the request thread, see releaseEvicted
+                self.evicted.append(key)
+
+    def registerDependencies(self, projectfile, lang, ts_file, json_file):
+        if dependencyRegistry:
+            for path in [ts_file, json_file]:
+                dependencyRegistry().add(path, ("translations", projectfile, lang), self.invalidate)
+
+    def releaseEvicted(self):
+        """ Unregisters the dependencies of the evicted bundles which were not cached again """
+        with self.lock:
+            keys = [key for key in self.evicted if key not in self.cache and key not in self.pending]
+            self.evicted = []
+        if dependencyRegistry:
+            for key in keys:
+                dependencyRegistry().remove(("translations",) + key)
+
+    def invalidate(self, key):
+        """ Drops a cached bundle after one of its translation files changed """
+        with self.lock:
+            self.cache.pop(key[1:], None)
+
+    def buildTranslations(self, names, ts_file, json_file):
+        """ Returns the translations read from the TS and JSON translation files, names maps the
+            layer ids to the layer names """
+        # Handle "GetTranslations" request
+        QgsMessageLog.logMessage('Looking for *.ts translation files', "[GetTranslationsService]", Qgis.Info)
+
+        translations = {}
         if os.path.exists(ts_file):
             QgsMessageLog.logMessage('Found translation %s' % ts_file, "[GetTranslationsService]", Qgis.Info)
             try:
-                ts_document = ElementTree.parse(ts_file)
-
-                # Build translation string lookup
-                for context in ts_document.findall("./context"):
-                    context_name = context.find('./name')
-                    if context_name is None:
-                        continue
-
-                    context_name_parts = context_name.text.split(":")
-                    key = None
-                    if len(context_name_parts) >= 3 and context_name_parts[0] == "project" and context_name_parts[1] == "layers":
-                        # replace layer id with layer name
-                        maplayer = project.mapLayer(context_name_parts[2])
-                        try:
-                            layername = maplayer.serverProperties().shortName() or maplayer.name()
-                        except:
-                            layername = maplayer.shortName() or maplayer.name()
-
-                        if len(context_name_parts) == 3:
-                            ts_path = f"layertree"
-                            key = layername
-                        elif len(context_name_parts) == 4 and context_name_parts[3] == "fieldaliases":
-                            ts_path = f"layers.{layername}.fields"
-                        elif len(context_name_parts) == 4 and context_name_parts[3] == "formcontainers":
-                            ts_path = f"layers.{layername}.form"
-                    elif len(context_name_parts) == 2 and context_name_parts[0] == "project" and context_name_parts[1] == "layergroups":
-                        ts_path = f"layertree"
-                    else:
-                        # Unknown ts context
-                        continue
-
-                    context_ts = translations
-                    for entry in ts_path.split("."):
-                        context_ts[entry] = context_ts.get(entry, {})
-                        context_ts = context_ts[entry]
-
-                    for message in context.findall("./message"):
-                        source = message.find('./source')
-                        translation = message.find('./translation')
-                        if source is not None and translation is not None and translation.get('type', '') != "unfinished":
-                            context_ts[key or source.text] = translation.text
+                # Stream the document, and discard each context once it is processed
+                events = ElementTree.iterparse(ts_file, events=("start", "end"))
+                _, root = next(events)
+                for event, element in events:
+                    if event == "end" and element.tag == "context":
+                        addContextTranslations(translations, element, names)
+                        root.clear()
 
             except Exception as e:
                 QgsMessageLog.logMessage('Failed to read TS translation %s: %s' % (ts_file, str(e)), "[GetTranslationsService]", Qgis.Info)
@@ -100,9 +406,6 @@ class GetTranslationsService(QgsService):
         else:
             QgsMessageLog.logMessage('No TS translation %s found' % ts_file, "[GetTranslationsService]", Qgis.Info)
 
-        json_file = os.path.join(dirname, f"{filename[0]}_{lang}.json")
-        if not os.path.exists(json_file):
-            json_file = os.path.join(dirname, f"{filename[0]}_{lang[0:2]}.json")
         if os.path.exists(json_file):
             try:
                 with open(json_file) as fh:
@@ -113,7 +416,7 @@ class GetTranslationsService(QgsService):
         else:
             QgsMessageLog.logMessage('No JSON translation %s found' % json_file, "[GetTranslationsService]", Qgis.Info)
 
-        response.write(json.dumps(translations))
+        return translations
 
 class GetTranslations:
     def __init__(self, serverIface):
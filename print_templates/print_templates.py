@@ -20,12 +20,116 @@ from qgis.PyQt.QtCore import QFile, QIODevice
 from qgis.PyQt.QtXml import QDomDocument
 import os
 
+try:
+    from clear_capabilities.dependencies import dependencyRegistry
+except ImportError:
+    dependencyRegistry = None
+
+class TemplateIndex:
+    """ Index of the print templates in a layout directory and its subdirectories.
+
+    Maps the directories to the template name -> (path, mtime, parsed document) of their .qpt files.
+    Directories and templates are registered with the dependency registry of the clear_capabilities
+    plugin, and rescanned on the next lookup after a change. Without the registry, directories are
+    rescanned on every lookup. Only new and modified files are parsed again.
+
+    Lookups are confined to the layout directory, and only directories found by scanning it are
+    searched. Symbolic links to directories are followed, but each directory is indexed only once,
+    so that links pointing to an ancestor directory don't recurse.
+    """
+
+    def __init__(self, layoutDir):
+        self.layoutDir = os.path.abspath(layoutDir)
+        # Directory -> {path: (mtime, template name, QDomDocument)}
+        self.dirs = {}
+        # Real path -> directory, of the indexed directories
+        self.realpaths = {}
+        # Directories which changed since they were scanned
+        self.dirty = set()
+        self.scan(self.layoutDir)
+
+    def changed(self, key):
+        self.dirty.add(key[1])
+
+    def template(self, subdirpath, templateName):
+        """ Returns the parsed document of the template in the subdirectory, or None """
+        layoutDir = os.path.normpath(os.path.join(self.layoutDir, subdirpath))
+        if os.path.commonpath([self.layoutDir, layoutDir]) != self.layoutDir:
+            QgsMessageLog.logMessage('Template directory %s outside PRINT_LAYOUT_DIR' % subdirpath, 'plugin', Qgis.MessageLevel.Warning)
+            return None
+        # Rescan the changed directories from the layout directory down, to index new subdirectories
+        dirpath = self.layoutDir
+        for part in os.path.relpath(layoutDir, self.layoutDir).split(os.sep):
+            if part != os.curdir:
+                dirpath = os.path.join(dirpath, part)
+            if dirpath in self.dirty:
+                self.scan(dirpath)
+        for mtime, name, domDoc in self.dirs.get(layoutDir, {}).values():
+            if name == templateName:
+                return domDoc
+        return None
+
+    def scan(self, layoutDir):
+        """ Updates the index of the directory, and indexes new subdirectories """
+        self.dirty.discard(layoutDir)
+        # The directory and its templates are registered again below
+        key = ("print_templates", layoutDir)
+        if dependencyRegistry:
+            dependencyRegistry().remove(key)
+        try:
+            realpath = os.path.realpath(layoutDir)
+            if self.realpaths.get(realpath, layoutDir) != layoutDir:
+                # Already indexed under another path, i.e. a link to an ancestor directory
+                return
+            entries = list(os.scandir(layoutDir))
+        except OSError:
+            self.dirs.pop(layoutDir, None)
+            self.realpaths = dict((real, path) for real, path in self.realpaths.items() if path != layoutDir)
+            return
+        self.realpaths[realpath] = layoutDir
+
+        # Directories which cannot be watched are rescanned on every lookup
+        if not dependencyRegistry or not dependencyRegistry().add(layoutDir, key, self.changed):
+            self.dirty.add(layoutDir)
+
+        indexed = self.dirs.get(layoutDir, {})
+        templates = {}
+        for entry in entries:
+            if entry.is_dir():
+                if entry.path not in self.dirs:
+                    self.scan(entry.path)
+                continue
+            if not entry.name.endswith('.qpt'):
+                continue
+
+            if dependencyRegistry:
+                dependencyRegistry().add(entry.path, key, self.changed)
+            mtime = entry.stat().st_mtime_ns
+            if entry.path in indexed and indexed[entry.path][0] == mtime:
+                templates[entry.path] = indexed[entry.path]
+                continue
+
+            layoutFile = QFile(entry.path)
+            if not layoutFile.open( QIODevice.ReadOnly ):
+                QgsMessageLog.logMessage('Opening file failed', 'plugin', Qgis.MessageLevel.Critical)
+                continue
+            domDoc = QDomDocument()
+            if not domDoc.setContent(layoutFile):
+                QgsMessageLog.logMessage('Reading xml document failed', 'plugin', Qgis.MessageLevel.Critical)
+                continue
+            templates[entry.path] = (mtime, domDoc.documentElement().attribute('name'), domDoc)
+
+        self.dirs[layoutDir] = templates
+
 class PrintTemplatesFilter(QgsServerFilter):
     def __init__(self, serverIface):
         super(PrintTemplatesFilter, self).__init__(serverIface)
-        self.__layouts = []
-        self.__project = None
-        
+        self.__index = None
+        if 'PRINT_LAYOUT_DIR' in os.environ:
+            self.__index = TemplateIndex(os.environ['PRINT_LAYOUT_DIR'])
+        # (project, layout) of the layout added to the project for the current GetPrint
+        self.__added = None
+
     def onRequestReady(self):
         
         #Only add print layouts for GetProjectSettings and for GetPrint
@@ -42,54 +146,42 @@ class PrintTemplatesFilter(QgsServerFilter):
         
         projectPath = self.serverInterface().configFilePath()
         try:
-            self.__project = QgsConfigCache.instance().project( projectPath )
+            project = QgsConfigCache.instance().project( projectPath )
         except:
-            self.__project = None
+            return True
+        if not project:
             return True
 
-        if 'PRINT_LAYOUT_DIR' not in os.environ:
+        if not self.__index:
             QgsMessageLog.logMessage('PRINT_LAYOUT_DIR not set', 'plugin', Qgis.MessageLevel.Warning)
             return True
 
-        QgsMessageLog.logMessage('Looking for templates in %s' % os.environ.get('PRINT_LAYOUT_DIR', ''), 'plugin', Qgis.MessageLevel.Info)
-        
-        layoutDir = os.path.join(os.environ['PRINT_LAYOUT_DIR'], subdirpath)
-        for f in os.listdir(layoutDir):
-            layoutFile = QFile(os.path.join(layoutDir,f))
-            if not layoutFile.open( QIODevice.ReadOnly ):
-                QgsMessageLog.logMessage('Opening file failed', 'plugin', Qgis.MessageLevel.Critical)
-                continue
-            domDoc = QDomDocument()
-            if not domDoc.setContent(layoutFile):
-                QgsMessageLog.logMessage('Reading xml document failed', 'plugin', Qgis.MessageLevel.Critical)
-                continue
-
-            #Check if template name maches template parameter in request
-            if not domDoc.documentElement().attribute('name') == templateName:
-                continue
+        domDoc = self.__index.template(subdirpath, templateName)
+        if domDoc is None:
+            return True
 
-            layout = QgsPrintLayout(self.__project)
-            if not layout.readXml( domDoc.documentElement(), domDoc, QgsReadWriteContext() ):
-                QgsMessageLog.logMessage('Reading layout failed', 'plugin', Qgis.MessageLevel.Critical)
-            else:
-                QgsMessageLog.logMessage('Reading of layout was successfull', 'plugin', Qgis.MessageLevel.Info)
+        # The layout is read from the indexed document for each GetPrint and added to the layout
+        # manager of the project for the duration of the request only, so that it is neither
+        # listed in other responses nor modified across requests.
+        layout = QgsPrintLayout(project)
+        if not layout.readXml( domDoc.documentElement(), domDoc, QgsReadWriteContext() ):
+            QgsMessageLog.logMessage('Reading layout failed', 'plugin', Qgis.MessageLevel.Critical)
+        else:
+            QgsMessageLog.logMessage('Reading of layout was successfull', 'plugin', Qgis.MessageLevel.Info)
 
-            if not self.__project.layoutManager().addLayout(layout):
-                QgsMessageLog.logMessage('Could not add layout to project', 'plugin', Qgis.MessageLevel.Critical)
+        if not project.layoutManager().addLayout(layout):
+            QgsMessageLog.logMessage('Could not add layout to project', 'plugin', Qgis.MessageLevel.Critical)
+            return True
+        self.__added = (project, layout)
 
-            self.__layouts.append(layout)
-            break
-        
         return True
-    
+
     def onResponseComplete(self):
-        if self.__project:
-            for layout in self.__layouts:
-                self.__project.layoutManager().removeLayout(layout)
-            
-        self.__layouts.clear()
-        self.__project = None
-        
+        # Remove the layout added for the GetPrint request
+        if self.__added is not None:
+            project, layout = self.__added
+            self.__added = None
+            project.layoutManager().removeLayout(layout)
         return True
 
 class PrintTemplates:
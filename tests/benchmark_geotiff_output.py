@@ -0,0 +1,171 @@
+#
+# Copyright (c) 2023 Marco Hugentobler, Sourcepole AG
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Benchmark of the wms_geotiff_output GeoTIFF conversion. Run with
+`python tests/benchmark_geotiff_output.py` from the repository root.
+Requires QGIS, GDAL and NumPy, and is skipped if one of them is missing.
+
+Reports the time per megapixel of the QImage to GDAL conversion, of the
+former per-pixel loop and of the NumPy view, and the encoding time and
+output size of each GEOTIFF_PROFILES entry.
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+try:
+    from osgeo import gdal
+    import numpy
+    from qgis.PyQt.QtCore import QRect, Qt
+    from qgis.PyQt.QtGui import (
+        QColor, QImage, QPainter, QPen, qAlpha, qBlue, qGreen, qRed)
+    from qgis.server import QgsServer
+    from wms_geotiff_output.vsimem import VsiMemFile
+    from wms_geotiff_output.wms_geotiff_output import (
+        GEOTIFF_PROFILES, WMSGeotiffFilter)
+except ImportError as e:
+    print("Benchmark skipped: %s" % e)
+    sys.exit(0)
+
+
+# Image sizes of the NumPy conversion, respectively of the slow per-pixel loop
+SIZES = [512, 1024, 2048, 4096]
+LOOP_SIZES = [256, 512]
+REPEAT = 3
+# Image size of the profile comparison
+PROFILE_SIZE = 1024
+
+
+def mapImage(size, opaque=True, seed=42):
+    """ Returns a map-like ARGB32 image with filled polygons and lines """
+    rng = random.Random(seed)
+    img = QImage(size, size, QImage.Format_ARGB32_Premultiplied)
+    img.fill(QColor(255, 255, 255) if opaque else Qt.transparent)
+    painter = QPainter(img)
+    painter.setRenderHint(QPainter.Antialiasing)
+    for i in range(size // 8):
+        color = QColor(rng.randrange(256), rng.randrange(256), rng.randrange(256))
+        x, y = rng.randrange(size), rng.randrange(size)
+        painter.fillRect(QRect(x, y, rng.randrange(size // 8), rng.randrange(size // 8)), color)
+        painter.setPen(QPen(color.darker(), 2))
+        painter.drawLine(x, y, rng.randrange(size), rng.randrange(size))
+    painter.end()
+    return img
+
+
+def memDataset(size):
+    return gdal.GetDriverByName('MEM').Create('', size, size, 4, gdal.GDT_Byte)
+
+
+def loopConversion(filt, ds, img):
+    """ The conversion before the NumPy view, one interpreter iteration per pixel """
+    w = img.width()
+    h = img.height()
+    data = [numpy.zeros((h, w), dtype=numpy.uint8) for band in range(4)]
+    for i in range(h):
+        for j in range(w):
+            rgb = img.pixel(j, i)
+            data[0][i, j] = qRed(rgb)
+            data[1][i, j] = qGreen(rgb)
+            data[2][i, j] = qBlue(rgb)
+            data[3][i, j] = qAlpha(rgb)
+    for band in range(4):
+        ds.GetRasterBand(band + 1).WriteArray(data[band])
+        ds.GetRasterBand(band + 1).FlushCache()
+
+
+def numpyConversion(filt, ds, img):
+    img, pixels = filt.imageToArray(img)
+    filt.writeImageToGDALDataSource(ds, pixels)
+
+
+def timed(function, *args):
+    """ Returns the best time of REPEAT runs of function in seconds """
+    best = None
+    for i in range(REPEAT):
+        start = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmarkConversion(filt):
+    print("QImage to GDAL conversion [ms per megapixel]")
+    print("%-8s %10s %10s" % ("size", "loop", "numpy"))
+    for size in sorted(set(SIZES + LOOP_SIZES)):
+        img = mapImage(size)
+        megapixels = size * size / 1e6
+        loop = ""
+        if size in LOOP_SIZES:
+            loop = "%.1f" % (timed(loopConversion, filt, memDataset(size), img) * 1000 / megapixels)
+        vectorized = ""
+        if size in SIZES:
+            vectorized = "%.1f" % (timed(numpyConversion, filt, memDataset(size), img) * 1000 / megapixels)
+        print("%-8d %10s %10s" % (size, loop, vectorized))
+
+    # Both conversions write the same pixels
+    img = mapImage(LOOP_SIZES[0], opaque=False)
+    expected, actual = memDataset(LOOP_SIZES[0]), memDataset(LOOP_SIZES[0])
+    loopConversion(filt, expected, img)
+    numpyConversion(filt, actual, img)
+    assert (expected.ReadAsArray() == actual.ReadAsArray()).all()
+
+
+def encode(filt, img, profile):
+    """ Returns the GeoTIFF bytes of img encoded with profile """
+    with VsiMemFile() as vsiFile:
+        if not filt.writeGeoTiff(vsiFile.path, img, profile, "0,0,1000,1000", "EPSG:2056"):
+            raise RuntimeError("GeoTIFF encoding failed")
+        return vsiFile.read()
+
+
+def benchmarkProfiles(filt):
+    print("GeoTIFF profiles, %dx%d [ms, KB]" % (PROFILE_SIZE, PROFILE_SIZE))
+    print("%-10s %10s %10s %10s %10s" % (
+        "profile", "opaque ms", "opaque KB", "alpha ms", "alpha KB"))
+    images = [mapImage(PROFILE_SIZE), mapImage(PROFILE_SIZE, opaque=False)]
+    # As set by the filter for the rgbmask profiles
+    gdal.SetThreadLocalConfigOption('GDAL_TIFF_INTERNAL_MASK', 'YES')
+    try:
+        for name, profile in GEOTIFF_PROFILES.items():
+            columns = []
+            for img in images:
+                elapsed = timed(encode, filt, img, profile)
+                columns += [
+                    "%.1f" % (elapsed * 1000),
+                    "%.1f" % (len(encode(filt, img, profile)) / 1024)
+                ]
+            print("%-10s %10s %10s %10s %10s" % tuple([name] + columns))
+    finally:
+        gdal.SetThreadLocalConfigOption('GDAL_TIFF_INTERNAL_MASK', None)
+
+
+def main():
+    server = QgsServer()
+    filt = WMSGeotiffFilter(server.serverInterface())
+    benchmarkConversion(filt)
+    print()
+    benchmarkProfiles(filt)
+
+
+if __name__ == "__main__":
+    main()
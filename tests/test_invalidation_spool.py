@@ -0,0 +1,155 @@
+#
+# Copyright (c) 2024 Marco Hugentobler, Sourcepole AG
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests of the clear_capabilities invalidation spool with several local
+processes. Run with `python -m unittest discover tests` from the
+repository root, QGIS is not required.
+"""
+
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from clear_capabilities.spool import InvalidationSpool  # noqa: E402
+
+
+TIMEOUT = 10
+
+
+def worker(spool_dir, ready, results, expected):
+    """ Polls the spool until the expected number of invalidations arrived """
+    spool = InvalidationSpool(spool_dir)
+    ready.release()
+    projects = []
+    deadline = time.monotonic() + TIMEOUT
+    while len(projects) < expected and time.monotonic() < deadline:
+        projects += spool.poll()
+        time.sleep(0.01)
+    results.put((os.getpid(), sorted(projects)))
+
+
+def publisher(spool_dir, start, projects):
+    """ Publishes projects once start is set """
+    spool = InvalidationSpool(spool_dir)
+    start.wait()
+    for project in projects:
+        spool.publish(project)
+
+
+class InvalidationSpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.spool_dir = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def startWorkers(self, count, expected):
+        ready = multiprocessing.Semaphore(0)
+        results = multiprocessing.Queue()
+        workers = [
+            multiprocessing.Process(
+                target=worker,
+                args=(self.spool_dir, ready, results, expected))
+            for i in range(count)
+        ]
+        for process in workers:
+            process.start()
+        for process in workers:
+            self.assertTrue(ready.acquire(timeout=TIMEOUT))
+        return workers, results
+
+    def publish(self, projects):
+        """ Publishes projects from another process """
+        start = multiprocessing.Event()
+        start.set()
+        process = multiprocessing.Process(
+            target=publisher, args=(self.spool_dir, start, projects))
+        process.start()
+        process.join(TIMEOUT)
+
+    def collect(self, workers, results):
+        received = [results.get(timeout=TIMEOUT) for process in workers]
+        for process in workers:
+            process.join(TIMEOUT)
+        return received
+
+    def test_all_workers_receive_invalidation(self):
+        workers, results = self.startWorkers(4, 1)
+        InvalidationSpool(self.spool_dir).publish("/data/a.qgs")
+
+        for pid, projects in self.collect(workers, results):
+            self.assertEqual(projects, ["/data/a.qgs"])
+
+    def test_concurrent_publishers(self):
+        projects = ["/data/p{}.qgs".format(i) for i in range(20)]
+        workers, results = self.startWorkers(2, len(projects))
+        start = multiprocessing.Event()
+        publishers = [
+            multiprocessing.Process(
+                target=publisher,
+                args=(self.spool_dir, start, projects[i::4]))
+            for i in range(4)
+        ]
+        for process in publishers:
+            process.start()
+        start.set()
+        for process in publishers:
+            process.join(TIMEOUT)
+
+        for pid, received in self.collect(workers, results):
+            self.assertEqual(received, sorted(projects))
+        self.assertEqual(
+            [name for name in os.listdir(self.spool_dir)
+             if not name.endswith(".inv")], [])
+
+    def test_idle_worker_receives_latest_invalidation(self):
+        idle = InvalidationSpool(self.spool_dir)
+        self.publish(["/data/a.qgs"] * 5 + ["/data/b.qgs"])
+
+        # A single poll after many publications still sees every project
+        self.assertEqual(sorted(idle.poll()), ["/data/a.qgs", "/data/b.qgs"])
+        self.assertEqual(idle.poll(), [])
+
+        self.publish(["/data/a.qgs"])
+        self.assertEqual(idle.poll(), ["/data/a.qgs"])
+
+    def test_own_and_earlier_invalidations_are_ignored(self):
+        self.publish(["/data/old.qgs"])
+        spool = InvalidationSpool(self.spool_dir)
+        self.assertEqual(spool.poll(), [])
+
+        spool.publish("/data/own.qgs")
+        self.assertEqual(spool.poll(), [])
+
+    def test_malformed_and_temporary_files_are_skipped(self):
+        spool = InvalidationSpool(self.spool_dir)
+        with open(os.path.join(self.spool_dir, ".1234.inv"), "w") as fh:
+            fh.write("garbage")
+        with open(os.path.join(self.spool_dir, "x.inv.1234.tmp"), "w") as fh:
+            fh.write("1234\n1\n/data/tmp.qgs")
+        self.assertEqual(spool.poll(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
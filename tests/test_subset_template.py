@@ -0,0 +1,134 @@
+#
+# Copyright (c) 2025 Sandro Mani, Sourcepole AG
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Tests of the datasource_filter_username subset templates. Run with
+`python -m unittest discover tests` from the repository root, QGIS is not
+required.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+os.environ["DATASOURCE_FILTER_PLACEHOLDERS"] = "QWC_USERNAME,QWC_GROUPS"
+os.environ["DATASOURCE_FILTER_LIST_PLACEHOLDERS"] = "QWC_GROUPS"
+
+from datasource_filter_username.subset_template import SubsetTemplate  # noqa: E402
+
+
+USER = {"QWC_USERNAME": "bob", "QWC_GROUPS": "admins,editors"}
+
+
+def render(template, values=USER):
+    return SubsetTemplate(template).render(values)
+
+
+class SubsetTemplateTest(unittest.TestCase):
+
+    def test_code_placeholder_is_quoted(self):
+        self.assertEqual(render("owner = $QWC_USERNAME$"), "owner = 'bob'")
+
+    def test_string_placeholder_is_escaped(self):
+        self.assertEqual(
+            render("owner LIKE '%$QWC_USERNAME$%'"), "owner LIKE '%bob%'")
+
+    def test_escape_string(self):
+        values = {"QWC_USERNAME": "o'b\\"}
+        self.assertEqual(
+            render("owner = E'$QWC_USERNAME$'", values),
+            "owner = E'o''b\\\\'")
+        self.assertEqual(
+            render("owner = e'\\'$QWC_USERNAME$'", values),
+            "owner = e'\\'o''b\\\\'")
+        # An identifier ending in E does not start an escape string
+        self.assertEqual(
+            render("name = '$QWC_USERNAME$'", values), "name = 'o''b\\'")
+
+    def test_value_with_quotes_and_backslashes(self):
+        values = {"QWC_USERNAME": "x' OR '1'='1\\"}
+        self.assertEqual(
+            render("owner = $QWC_USERNAME$", values),
+            "owner = 'x'' OR ''1''=''1\\'")
+        self.assertEqual(
+            render("owner = '$QWC_USERNAME$'", values),
+            "owner = 'x'' OR ''1''=''1\\'")
+
+    def test_quoted_identifier_with_quote(self):
+        # The ' within the identifier does not start a string
+        self.assertEqual(
+            render('"it\'s $QWC_USERNAME$" = $QWC_USERNAME$'),
+            '"it\'s $QWC_USERNAME$" = \'bob\'')
+        self.assertEqual(
+            render('"a""$QWC_USERNAME$" = $QWC_USERNAME$'),
+            '"a""$QWC_USERNAME$" = \'bob\'')
+
+    def test_line_comment(self):
+        self.assertEqual(
+            render("owner = $QWC_USERNAME$ -- $QWC_USERNAME$\nOR true"),
+            "owner = 'bob' -- $QWC_USERNAME$\nOR true")
+
+    def test_nested_block_comment(self):
+        self.assertEqual(
+            render("/* a /* $QWC_USERNAME$ */ ' $QWC_USERNAME$ */ "
+                   "owner = $QWC_USERNAME$"),
+            "/* a /* $QWC_USERNAME$ */ ' $QWC_USERNAME$ */ owner = 'bob'")
+
+    def test_list_placeholder(self):
+        self.assertEqual(
+            render("grp IN ($QWC_GROUPS$)"), "grp IN ('admins', 'editors')")
+        self.assertEqual(
+            render("grp IN ($QWC_GROUPS$)", {"QWC_GROUPS": "a'b,c"}),
+            "grp IN ('a''b', 'c')")
+        self.assertEqual(
+            render("grp IN ($QWC_GROUPS$)", {"QWC_GROUPS": ""}),
+            "grp IN (NULL)")
+
+    def test_missing_value(self):
+        self.assertEqual(render("owner = $QWC_USERNAME$", {}), "owner = ''")
+
+    def test_unknown_placeholder_is_left_unchanged(self):
+        self.assertEqual(
+            render("a = '$QWC_OTHER$' AND owner = $QWC_USERNAME$"),
+            "a = '$QWC_OTHER$' AND owner = 'bob'")
+
+    def test_dollar_quoted_string(self):
+        self.assertEqual(
+            render("a = $$ $QWC_USERNAME$ $$ AND owner = $QWC_USERNAME$"),
+            "a = $$ $QWC_USERNAME$ $$ AND owner = 'bob'")
+        self.assertEqual(
+            render("a = $x$ $$ ' $QWC_USERNAME$ $x$ AND b = $QWC_USERNAME$"),
+            "a = $x$ $$ ' $QWC_USERNAME$ $x$ AND b = 'bob'")
+        # Unknown placeholders are left in the SQL, where they are tags
+        self.assertEqual(
+            render("a = $QWC_OTHER$ $QWC_USERNAME$ $QWC_OTHER$"),
+            "a = $QWC_OTHER$ $QWC_USERNAME$ $QWC_OTHER$")
+
+    def test_dollar_in_identifier_and_parameter(self):
+        self.assertEqual(
+            render("foo$bar$ = $QWC_USERNAME$"), "foo$bar$ = 'bob'")
+        self.assertEqual(
+            render("$1 = $QWC_USERNAME$"), "$1 = 'bob'")
+
+    def test_placeholders(self):
+        template = SubsetTemplate(
+            "owner = $QWC_USERNAME$ -- $QWC_GROUPS$")
+        self.assertEqual(template.placeholders, {"QWC_USERNAME"})
+
+
+if __name__ == "__main__":
+    unittest.main()
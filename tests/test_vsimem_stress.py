@@ -0,0 +1,125 @@
+#
+# Copyright (c) 2023 Marco Hugentobler, Sourcepole AG
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Stress test of the wms_geotiff_output in-memory files with many concurrent
+conversions. Run with `python -m unittest discover tests` from the
+repository root, QGIS is not required. Skipped if GDAL or NumPy is not
+installed.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import resource
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+try:
+    from osgeo import gdal
+    import numpy
+    from wms_geotiff_output.vsimem import VsiMemFile
+except ImportError:
+    gdal = None
+
+
+THREADS = 8
+ROUNDS = 40
+SIZE = 512
+# Allowed RSS growth between the warm-up and the end of the test
+MAX_RSS_GROWTH = 32 * 1024 * 1024
+
+
+def rss():
+    """ Returns the resident set size of the process in bytes """
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # Peak instead of current RSS, still catches steady growth
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def convert(seed):
+    """ Encodes a random RGBA image as GeoTIFF through a VsiMemFile, and
+        returns the image and the TIFF bytes
+    """
+    pixels = numpy.random.default_rng(seed).integers(
+        0, 256, (SIZE, SIZE, 4), dtype=numpy.uint8)
+    with VsiMemFile() as vsiFile:
+        ds = gdal.GetDriverByName('GTiff').Create(
+            vsiFile.path, SIZE, SIZE, 4, gdal.GDT_Byte,
+            ['COMPRESS=LZW', 'INTERLEAVE=PIXEL'])
+        ds.WriteRaster(
+            0, 0, SIZE, SIZE, pixels.tobytes(), SIZE, SIZE, gdal.GDT_Byte,
+            [1, 2, 3, 4], buf_pixel_space=4, buf_line_space=SIZE * 4,
+            buf_band_space=1)
+        ds = None
+        return pixels, vsiFile.read()
+
+
+def decode(tiffBytes):
+    """ Returns the (height, width, bands) pixels of TIFF bytes """
+    with VsiMemFile() as vsiFile:
+        gdal.FileFromMemBuffer(vsiFile.path, tiffBytes)
+        ds = gdal.Open(vsiFile.path)
+        pixels = ds.ReadAsArray().transpose(1, 2, 0)
+        ds = None
+        return pixels
+
+
+def vsimemFiles():
+    return [
+        name for name in gdal.ReadDir('/vsimem/') or []
+        if name.startswith('wms_geotiff_output_')
+    ]
+
+
+@unittest.skipUnless(gdal, "GDAL or NumPy is not installed")
+class VsiMemFileStressTest(unittest.TestCase):
+
+    def run_rounds(self, executor, seeds):
+        for pixels, tiffBytes in executor.map(convert, seeds):
+            self.assertTrue(tiffBytes.startswith((b'II*\x00', b'MM\x00*')))
+            numpy.testing.assert_array_equal(decode(tiffBytes), pixels)
+
+    def test_concurrent_conversions(self):
+        with ThreadPoolExecutor(max_workers=THREADS) as executor:
+            # Warm up allocator arenas and GDAL caches
+            self.run_rounds(executor, range(THREADS * 2))
+            before = rss()
+            self.run_rounds(executor, range(THREADS * ROUNDS))
+            after = rss()
+
+        self.assertEqual(vsimemFiles(), [])
+        self.assertLess(after - before, MAX_RSS_GROWTH)
+
+    def test_unlinked_on_failure(self):
+        with self.assertRaises(RuntimeError):
+            with VsiMemFile() as vsiFile:
+                gdal.FileFromMemBuffer(vsiFile.path, b'partial')
+                gdal.FileFromMemBuffer(vsiFile.path + '.msk', b'mask')
+                raise RuntimeError("encoding failed")
+        self.assertEqual(vsimemFiles(), [])
+
+    def test_unique_paths(self):
+        paths = set(VsiMemFile().path for i in range(1000))
+        self.assertEqual(len(paths), 1000)
+
+
+if __name__ == "__main__":
+    unittest.main()
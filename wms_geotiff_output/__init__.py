@@ -14,8 +14,7 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
-from .wms_geotiff_output import WMSGeotiffOutput
-
 
 def serverClassFactory(serverIface):
+    from .wms_geotiff_output import WMSGeotiffOutput
     return WMSGeotiffOutput(serverIface)
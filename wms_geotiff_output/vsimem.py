@@ -0,0 +1,60 @@
+#
+# Copyright (c) 2023 Marco Hugentobler, Sourcepole AG
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Per-request in-memory GDAL files.
+
+Only depends on GDAL, so that it can be tested without QGIS.
+"""
+
+from osgeo import gdal
+import uuid
+
+
+class VsiMemFile:
+    """ Uniquely named /vsimem/ file, which is unlinked when leaving the context.
+
+    Each conversion gets its own file, so that concurrent requests do not share
+    a buffer, and the memory is released even if encoding fails. Sidecar files
+    GDAL may create next to it, i.e. an external .msk mask, are unlinked too.
+    """
+
+    SIDECAR_SUFFIXES = ['', '.msk', '.aux.xml', '.ovr']
+
+    def __init__(self, suffix='.tif'):
+        self.path = '/vsimem/wms_geotiff_output_%s%s' % (uuid.uuid4().hex, suffix)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for suffix in self.SIDECAR_SUFFIXES:
+            if gdal.VSIStatL(self.path + suffix) is not None:
+                gdal.Unlink(self.path + suffix)
+        return False
+
+    def read(self):
+        """ Returns the contents of the file as bytes """
+        stat = gdal.VSIStatL(self.path, gdal.VSI_STAT_SIZE_FLAG)
+        if stat is None:
+            return b''
+        vsifile = gdal.VSIFOpenL(self.path, 'rb')
+        if not vsifile:
+            return b''
+        try:
+            return gdal.VSIFReadL(1, stat.size, vsifile)
+        finally:
+            gdal.VSIFCloseL(vsifile)
@@ -16,23 +16,76 @@
 
 from qgis.core import *
 from qgis.server import *
-from qgis.PyQt.QtGui import QImage, qRed, qGreen, qBlue, qAlpha
-from qgis.PyQt.QtCore import QByteArray
-import xml.dom.minidom
-from xml.dom.minidom import parseString
+from qgis.PyQt.QtGui import QImage, qRed, qGreen, qBlue
+from qgis.PyQt.QtCore import Qt, QByteArray
 from osgeo import gdal
+from .vsimem import VsiMemFile
 import numpy
+import os
+import re
+
+GETMAP_TAG_RE = re.compile(rb'<([\w.-]+:)?GetMap\b[^>]*>')
+FORMAT_TAG_RE = re.compile(rb'([ \t\r\n]*)(<([\w.-]+:)?Format\b)')
+
+# GeoTIFF encoding profiles, selected by the GEOTIFF_PROFILE GetMap parameter
+# or the WMS_GEOTIFF_PROFILE environment variable.
+#  - driver: GDAL driver used for writing
+#  - options: GDAL creation options
+#  - bands: 'rgba' always writes an alpha band, 'rgb' and 'paletted' drop the
+#    alpha band if the image is fully opaque, 'rgbmask' always writes RGB and
+#    stores transparency as internal mask
+GEOTIFF_PROFILES = {
+    'default': {'driver': 'GTiff', 'bands': 'rgba', 'options': [
+        'COMPRESS=LZW', 'INTERLEAVE=PIXEL']},
+    'tiled': {'driver': 'GTiff', 'bands': 'rgba', 'options': [
+        'COMPRESS=LZW', 'TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256']},
+    'fast': {'driver': 'GTiff', 'bands': 'rgba', 'options': [
+        'COMPRESS=ZSTD', 'ZSTD_LEVEL=1', 'PREDICTOR=2', 'TILED=YES', 'NUM_THREADS=ALL_CPUS']},
+    'deflate': {'driver': 'GTiff', 'bands': 'rgba', 'options': [
+        'COMPRESS=DEFLATE', 'ZLEVEL=6', 'PREDICTOR=2', 'TILED=YES']},
+    'zstd': {'driver': 'GTiff', 'bands': 'rgba', 'options': [
+        'COMPRESS=ZSTD', 'ZSTD_LEVEL=9', 'PREDICTOR=2', 'TILED=YES']},
+    'small': {'driver': 'GTiff', 'bands': 'rgb', 'options': [
+        'COMPRESS=DEFLATE', 'ZLEVEL=9', 'PREDICTOR=2', 'TILED=YES']},
+    'cog': {'driver': 'COG', 'bands': 'rgba', 'options': [
+        'COMPRESS=DEFLATE', 'PREDICTOR=YES', 'OVERVIEWS=AUTO', 'BLOCKSIZE=512']},
+    'jpeg': {'driver': 'GTiff', 'bands': 'rgbmask', 'options': [
+        'COMPRESS=JPEG', 'JPEG_QUALITY=85', 'PHOTOMETRIC=YCBCR', 'TILED=YES']},
+    'rgb': {'driver': 'GTiff', 'bands': 'rgb', 'options': [
+        'COMPRESS=LZW', 'PREDICTOR=2', 'TILED=YES']},
+    'paletted': {'driver': 'GTiff', 'bands': 'paletted', 'options': [
+        'COMPRESS=DEFLATE', 'TILED=YES']},
+}
+
 
 class WMSGeotiffFilter(QgsServerFilter):
     def __init__(self, serverIface):
         super(WMSGeotiffFilter, self).__init__(serverIface)
         self.__isFormatTiff = False #track format since we have to make the server return PNG
+        self.__isStreamed = False #track whether the image is converted strip-wise
+        self.__maxPixels = int(os.getenv('WMS_GEOTIFF_MAX_PIXELS', '0'))
+        self.__streamingPixels = int(os.getenv('WMS_GEOTIFF_STREAMING_PIXELS', str(4096 * 4096)))
+        self.__stripRows = max(1, int(os.getenv('WMS_GEOTIFF_STRIP_ROWS', '256')))
         
     def onRequestReady(self):
         request = self.serverInterface().requestHandler()
         if request.parameter('SERVICE').upper() == 'WMS' and request.parameter('REQUEST').upper() == 'GETMAP':
             if request.parameter('FORMAT').upper() == 'IMAGE/TIFF':
+                try:
+                    nPixels = int(request.parameter('WIDTH')) * int(request.parameter('HEIGHT'))
+                except ValueError:
+                    nPixels = 0
+
+                if self.__maxPixels > 0 and nPixels > self.__maxPixels:
+                    request.setServiceException(QgsServiceException(
+                        'InvalidParameterValue',
+                        'Requested image size exceeds the maximum of %d pixels for image/tiff' % self.__maxPixels,
+                        '', 400
+                    ))
+                    return True
+
                 request.setParameter('FORMAT','image/png')
+                self.__isStreamed = nPixels > self.__streamingPixels
                 self.__isFormatTiff = True
         return True
         
@@ -48,10 +101,11 @@ class WMSGeotiffFilter(QgsServerFilter):
         if requestParam == 'GETCAPABILITIES' or requestParam == 'GETPROJECTSETTINGS':
             self.modifyCapabilities(request)
         elif requestParam == 'GETMAP':
-            if self.__isFormatTiff:
+            if self.__isFormatTiff and not request.exceptionRaised():
                 self.modifyGetMap(request)
         
         self.__isFormatTiff = False
+        self.__isStreamed = False
         return True
     
     def writeGeorefInfo(self, geoTiffDS, extentString, crsString, width, height):
@@ -76,93 +130,232 @@ class WMSGeotiffFilter(QgsServerFilter):
         if crs.isValid():
             geoTiffDS.SetProjection(crs.toWkt())
     
-    def writeImageToGDALDataSource(self, ds, img):
-        redBand = ds.GetRasterBand( 1 )
-        greenBand = ds.GetRasterBand( 2 )
-        blueBand = ds.GetRasterBand( 3 )
-        alphaBand = ds.GetRasterBand( 4 )
-        
+    def imageToArray(self, img):
+        """ Returns a (height, width, 4) RGBA uint8 view on the pixel data of img.
+
+        The image is normalized to Format_RGBA8888, whose byte order is R, G, B, A
+        independently of the platform endianness. The returned array shares memory
+        with the returned image, which hence must be kept alive while the array is used.
+        """
+        if img.format() != QImage.Format_RGBA8888:
+            img = img.convertToFormat(QImage.Format_RGBA8888)
+
         w = img.width()
         h = img.height()
-        nPixels = img.width() * img.height()
-        
-        redData = numpy.zeros((h, w), dtype=numpy.uint8)
-        greenData = numpy.zeros((h, w), dtype=numpy.uint8)
-        blueData = numpy.zeros((h, w), dtype=numpy.uint8)
-        alphaData = numpy.zeros((h, w), dtype=numpy.uint8)
-        
-        for i in range (h):
-            for j in range (w):
-                rgb = img.pixel(j,i)
-                redData[i,j] = qRed(rgb)
-                greenData[i,j] = qGreen(rgb)
-                blueData[i,j] = qBlue(rgb)
-                alphaData[i,j] = qAlpha(rgb)
-        
-        redBand.WriteArray( redData )
-        redBand.FlushCache()
-        greenBand.WriteArray( greenData )
-        greenBand.FlushCache()
-        blueBand.WriteArray( blueData )
-        blueBand.FlushCache()
-        alphaBand.WriteArray( alphaData )
-        alphaBand.FlushCache()
-    
+        bytesPerLine = img.bytesPerLine()
+        bits = img.constBits()
+        bits.setsize(bytesPerLine * h)
+        # Scanlines may be padded, strip padding via slicing (no copy)
+        data = numpy.frombuffer(bits, dtype=numpy.uint8).reshape(h, bytesPerLine)
+        return img, data[:, 0:w * 4].reshape(h, w, 4)
+
+    def writeImageToGDALDataSource(self, ds, pixels):
+        h, w, nBands = pixels.shape
+
+        # Single pixel-interleaved write of all bands from the image buffer.
+        # RGBA8888 scanlines are never padded, so this does not copy unless
+        # bands were sliced off.
+        pixels = numpy.ascontiguousarray(pixels)
+        ds.WriteRaster(
+            0, 0, w, h, pixels, w, h, gdal.GDT_Byte, list(range(1, nBands + 1)),
+            buf_pixel_space=nBands, buf_line_space=pixels.strides[0], buf_band_space=1
+        )
+
+    def writePalettedImageToGDALDataSource(self, ds, img):
+        """ Writes img as a single paletted band """
+        img = img.convertToFormat(QImage.Format_Indexed8, Qt.ThresholdDither | Qt.AvoidDither)
+        w = img.width()
+        h = img.height()
+        bits = img.constBits()
+        bits.setsize(img.bytesPerLine() * h)
+        data = numpy.frombuffer(bits, dtype=numpy.uint8).reshape(h, img.bytesPerLine())
+
+        colorTable = gdal.ColorTable()
+        for idx, rgb in enumerate(img.colorTable()):
+            colorTable.SetColorEntry(idx, (qRed(rgb), qGreen(rgb), qBlue(rgb), 255))
+        band = ds.GetRasterBand(1)
+        band.SetRasterColorTable(colorTable)
+        band.SetRasterColorInterpretation(gdal.GCI_PaletteIndex)
+        band.WriteArray(data[:, 0:w])
+
+    def encodingProfile(self, requestHandler):
+        """ Returns the encoding profile for the request, from the GEOTIFF_PROFILE
+            parameter or the WMS_GEOTIFF_PROFILE environment variable
+        """
+        profileName = (requestHandler.parameter('GEOTIFF_PROFILE') or os.getenv('WMS_GEOTIFF_PROFILE', '') or 'default').lower()
+        if profileName not in GEOTIFF_PROFILES:
+            QgsMessageLog.logMessage("Unknown GeoTIFF profile %s, using default" % profileName, 'plugin', Qgis.Warning)
+            profileName = 'default'
+        return GEOTIFF_PROFILES[profileName]
+
+    def writeGeoTiff(self, path, img, profile, extentString, crsString):
+        """ Encodes img to a GeoTIFF at path according to profile. Returns False on failure. """
+        img, pixels = self.imageToArray(img)
+        h, w = pixels.shape[0:2]
+
+        bandMode = profile['bands']
+        opaque = bandMode != 'rgba' and bool(numpy.all(pixels[:, :, 3] == 255))
+        if bandMode == 'paletted' and not opaque:
+            bandMode = 'rgba'
+        elif bandMode == 'rgb' and not opaque:
+            bandMode = 'rgba'
+        nBands = {'rgba': 4, 'rgb': 3, 'rgbmask': 3, 'paletted': 1}[bandMode]
+
+        # The COG driver only supports CreateCopy, write to a MEM dataset first
+        if profile['driver'] == 'COG':
+            ds = gdal.GetDriverByName('MEM').Create('', w, h, nBands, gdal.GDT_Byte)
+        else:
+            ds = gdal.GetDriverByName(profile['driver']).Create(path, w, h, nBands, gdal.GDT_Byte, profile['options'])
+        if not ds:
+            return False
+
+        try:
+            self.writeGeorefInfo(ds, extentString, crsString, w, h)
+            if bandMode == 'paletted':
+                self.writePalettedImageToGDALDataSource(ds, img)
+            else:
+                self.writeImageToGDALDataSource(ds, pixels[:, :, 0:nBands])
+            if bandMode == 'rgbmask' and not opaque:
+                ds.CreateMaskBand(gdal.GMF_PER_DATASET)
+                ds.GetRasterBand(1).GetMaskBand().WriteArray(pixels[:, :, 3])
+            if bandMode == 'rgba':
+                ds.GetRasterBand(4).SetRasterColorInterpretation(gdal.GCI_AlphaBand)
+
+            if profile['driver'] == 'COG':
+                if not gdal.GetDriverByName('COG').CreateCopy(path, ds, options=profile['options']):
+                    return False
+        finally:
+            # Closing the dataset flushes the TIFF to the vsimem file
+            ds = None
+        return True
+
+    def writeGeoTiffStreamed(self, path, pngPath, profile, extentString, crsString):
+        """ Converts the PNG at pngPath to a GeoTIFF at path according to profile,
+            in strips of rows, so that the decoded image is never held in memory
+            as a whole. Returns False on failure.
+        """
+        src = gdal.Open(pngPath)
+        if not src or src.RasterCount not in (3, 4):
+            return False
+        w = src.RasterXSize
+        h = src.RasterYSize
+        hasAlpha = src.RasterCount == 4
+
+        if profile['driver'] == 'COG':
+            # The COG driver reads the source dataset block-wise by itself. Georeference
+            # an in-memory VRT wrapper rather than the read-only PNG.
+            vrt = gdal.GetDriverByName('VRT').CreateCopy('', src)
+            self.writeGeorefInfo(vrt, extentString, crsString, w, h)
+            return gdal.GetDriverByName('COG').CreateCopy(path, vrt, options=profile['options']) is not None
+
+        # Opacity is not known upfront, so 'rgb' and 'paletted' keep the alpha band
+        # of the source image, 'rgbmask' stores it as mask
+        bandMode = profile['bands']
+        nSrcBands = 4 if hasAlpha and bandMode != 'rgbmask' else 3
+        nBands = 4 if bandMode == 'rgba' else nSrcBands
+        ds = gdal.GetDriverByName(profile['driver']).Create(path, w, h, nBands, gdal.GDT_Byte, profile['options'])
+        if not ds:
+            return False
+
+        try:
+            self.writeGeorefInfo(ds, extentString, crsString, w, h)
+            if nBands == 4:
+                ds.GetRasterBand(4).SetRasterColorInterpretation(gdal.GCI_AlphaBand)
+            if bandMode == 'rgbmask' and hasAlpha:
+                ds.CreateMaskBand(gdal.GMF_PER_DATASET)
+
+            bandList = list(range(1, nSrcBands + 1))
+            for yOff in range(0, h, self.__stripRows):
+                rows = min(self.__stripRows, h - yOff)
+                strip = src.ReadRaster(
+                    0, yOff, w, rows, w, rows, gdal.GDT_Byte, bandList,
+                    buf_pixel_space=nSrcBands, buf_line_space=w * nSrcBands, buf_band_space=1
+                )
+                ds.WriteRaster(
+                    0, yOff, w, rows, strip, w, rows, gdal.GDT_Byte, bandList,
+                    buf_pixel_space=nSrcBands, buf_line_space=w * nSrcBands, buf_band_space=1
+                )
+                if nBands > nSrcBands:
+                    ds.GetRasterBand(4).WriteArray(numpy.full((rows, w), 255, dtype=numpy.uint8), 0, yOff)
+                elif bandMode == 'rgbmask' and hasAlpha:
+                    ds.GetRasterBand(1).GetMaskBand().WriteRaster(
+                        0, yOff, w, rows, src.GetRasterBand(4).ReadRaster(0, yOff, w, rows)
+                    )
+        finally:
+            ds = None
+        return True
+
     def modifyGetMap(self, requestHandler):
         pngData = requestHandler.body()
         requestHandler.clear()
         
-        img = QImage()
-        img.loadFromData(pngData,'png')
-        
-        gtiffDriver = gdal.GetDriverByName('GTiff')
-        vsiPath = '/vsimem/wms.tif'
-        gtiffDS = gtiffDriver.Create(vsiPath, img.width(), img.height(), 4, gdal.GDT_Byte, ['COMPRESS=LZW'] )
-        if not gtiffDS:
-            return
-        
+        profile = self.encodingProfile(requestHandler)
         extentString = requestHandler.parameter('BBOX')
         crsString = requestHandler.parameter('CRS')
         if not crsString:
             crsString = requestHandler.parameter('SRS')
-        self.writeGeorefInfo(gtiffDS, extentString, crsString,img.width(), img.height())
-        self.writeImageToGDALDataSource(gtiffDS, img)
-        gtiffDS = None
-        
-        #read from vsi
-        stat = gdal.VSIStatL(vsiPath, gdal.VSI_STAT_SIZE_FLAG)
-        vsifile = gdal.VSIFOpenL(vsiPath, 'r')
-        tiffBytes = gdal.VSIFReadL(1, stat.size, vsifile)
-        
+
+        # The mask of the 'jpeg' profile must be stored inside the TIFF, which is
+        # the only file returned to the client
+        gdal.SetThreadLocalConfigOption('GDAL_TIFF_INTERNAL_MASK', 'YES')
+        try:
+            with VsiMemFile() as vsiFile:
+                if self.__isStreamed:
+                    with VsiMemFile('.png') as pngFile:
+                        gdal.FileFromMemBuffer(pngFile.path, bytes(pngData))
+                        pngData = None
+                        if not self.writeGeoTiffStreamed(vsiFile.path, pngFile.path, profile, extentString, crsString):
+                            return
+                else:
+                    img = QImage()
+                    img.loadFromData(pngData,'png')
+                    pngData = None
+                    if not self.writeGeoTiff(vsiFile.path, img, profile, extentString, crsString):
+                        return
+
+                #read from vsi
+                tiffBytes = vsiFile.read()
+        finally:
+            gdal.SetThreadLocalConfigOption('GDAL_TIFF_INTERNAL_MASK', None)
+
         requestHandler.setResponseHeader( 'Content-Type', 'image/tiff' )
         requestHandler.appendBody(tiffBytes)
     
     def modifyCapabilities(self, requestHandler):
-        capabilitiesDoc = parseString(str(requestHandler.body(), encoding='utf-8'))
-        
-        getMapElems = capabilitiesDoc.getElementsByTagName('GetMap')
-        if len(getMapElems) < 1:
+        if requestHandler.exceptionRaised():
+            return
+
+        capabilities = self.injectTiffFormat(bytes(requestHandler.body()))
+        if capabilities is None:
             QgsMessageLog.logMessage("GetMap element not found", 'plugin', Qgis.Info)
             return
-        getMapElem = getMapElems[0]
-        formatElem = capabilitiesDoc.createElement('Format')
-        formatText = capabilitiesDoc.createTextNode('image/tiff')
-        formatElem.appendChild(formatText)
-        #Add Format tag as first entry in the format section
-        existingFormatElems = getMapElem.getElementsByTagName('Format')
-        if len(existingFormatElems) > 0:
-            getMapElem.insertBefore(formatElem, existingFormatElems[0])
-        else:
-            getMapElem.appendChild(formatElem)
-        
+
         #Set modified XML as response to request handler
         requestHandler.clear()
         requestHandler.setResponseHeader('Content-type', 'text/xml; charset=utf-8')
-        xmlString = capabilitiesDoc.toprettyxml()
-        xmlString = '<?xml version="1.0" encoding="utf-8"?>\n' + \
-            '\n'.join(xmlString.split('\n')[1:])
-        requestHandler.appendBody(bytes(xmlString, 'utf-8'))
-        
+        requestHandler.appendBody(capabilities)
+
+    def injectTiffFormat(self, capabilities):
+        """ Inserts <Format>image/tiff</Format> as first format of the GetMap
+            element, without re-serializing the document.
+            Returns None if there is no GetMap element.
+        """
+        getMapMatch = GETMAP_TAG_RE.search(capabilities)
+        if not getMapMatch:
+            return None
+        pos = getMapMatch.end()
+        prefix = getMapMatch.group(1) or b''
+        formatElem = b'<' + prefix + b'Format>image/tiff</' + prefix + b'Format>'
+
+        #Add Format tag as first entry in the format section, with the same indentation
+        end = capabilities.find(b'</' + prefix + b'GetMap>', pos)
+        formatMatch = FORMAT_TAG_RE.search(capabilities, pos, end if end >= 0 else len(capabilities))
+        if formatMatch:
+            indent = formatMatch.group(1)
+            pos = formatMatch.start(2)
+            return capabilities[:pos] + formatElem + indent + capabilities[pos:]
+        return capabilities[:pos] + formatElem + capabilities[pos:]
+
 class WMSGeotiffOutput:
     def __init__(self, serverIface):
         self.iface = serverIface